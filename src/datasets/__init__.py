@@ -1,7 +1,7 @@
-from src.utils.misc import ImportMisc
+from src.utils.misc import ConfigMisc, DistMisc, ImportMisc
 
-from .modules.data_module_base import (DataLoaderX, DataModuleBase,
-                                       data_module_register)
+from .modules.data_module_base import (CudaPrefetcher, DataLoaderX,
+                                       DataModuleBase, data_module_register)
 
 ImportMisc.import_current_dir_all(__file__, __name__)
 
@@ -10,13 +10,22 @@ class DataManager(object):
         self.loggers = loggers
         self.cfg = cfg
         self.data_module = self._get_data_module()
+        self.dataloaders = {}  # split -> dataloader, built once and reused (keeps the sampler and persistent workers)
+        if getattr(self.cfg.env, 'background_val_dataset', False) and not ConfigMisc.is_inference(self.cfg) \
+            and (self.cfg.trainer.dist_eval or DistMisc.is_main_process()):  # same condition as building the val_loader in the trainer
+            self.data_module.start_building_dataset('val')
         
     def _get_data_module(self):  # DataModule provides methods for getting train/val/test datasets
         data_module: DataModuleBase = data_module_register.get(self.cfg.data.dataset)(self.cfg)
         return data_module
         
     def build_dataloader(self, split) -> DataLoaderX:
+        if split in self.dataloaders:
+            return self.dataloaders[split]
         dataloader = self.data_module.get_dataloader(split)
+        if getattr(self.cfg.env, 'cuda_prefetch', False) and self.cfg.env.device == 'cuda':
+            dataloader = CudaPrefetcher(dataloader, self.cfg.env.device)
+        self.dataloaders[split] = dataloader
         print(f'{split} dataloader built successfully.')
         return dataloader
     
\ No newline at end of file
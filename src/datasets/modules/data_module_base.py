@@ -1,6 +1,8 @@
 import itertools
+import math
 import random
 import signal
+import threading
 from functools import partial
 
 import numpy as np
@@ -21,6 +23,8 @@ class DataModuleBase:
         self.train_dataset = None
         self.val_dataset = None
         self.test_dataset = None
+        self._generators = {}  # split -> torch.Generator, created once in `get_generator`
+        self._dataset_build_threads = {}  # split -> (thread, result), see `start_building_dataset`
         
     def build_train_dataset(self) -> Dataset:
         raise NotImplementedError
@@ -31,7 +35,35 @@ class DataModuleBase:
     def build_test_dataset(self) -> Dataset:            
         raise NotImplementedError
     
+    def start_building_dataset(self, split):
+        """
+        Build the val or test dataset in a background thread (e.g. indexing val files while the train dataset is being built).
+        `get_dataset(split)` waits for it and re-raises the error if the build failed.
+        """
+        assert split in ['val', 'test'], f'Invalid split {split} for building in background'
+        build_fn = self.build_val_dataset if split == 'val' else self.build_test_dataset
+        result = {}
+        
+        def _build():
+            try:
+                result['dataset'] = build_fn()
+            except BaseException as e:
+                result['error'] = e
+        
+        thread = threading.Thread(target=_build, name=f'build_{split}_dataset', daemon=True)
+        thread.start()
+        self._dataset_build_threads[split] = (thread, result)
+        
+    def _wait_for_building_dataset(self, split):
+        thread, result = self._dataset_build_threads.pop(split)
+        thread.join()
+        if 'error' in result:
+            raise result['error']
+        setattr(self, f'{split}_dataset', result['dataset'])
+    
     def get_dataset(self, split) -> Dataset:
+        if split in self._dataset_build_threads:
+            self._wait_for_building_dataset(split)
         if split == 'train':
             if self.train_dataset is None:
                 self.train_dataset = self.build_train_dataset()
@@ -47,63 +79,36 @@ class DataModuleBase:
         else:
             raise NotImplementedError(f'Invalid split {split}')
         
+    def register_shared_tensor(self, name, tensor: torch.Tensor) -> torch.Tensor:
+        """
+        Keep an in-memory dataset (or its metadata) as one tensor in shared memory, set as `self.<name>`, e.g. to be passed to the Datasets.
+        Only the small Python wrapper of a tensor has a refcount, so its data pages are not copied by copy-on-write in forked workers,
+        and with shared memory the workers started by spawn get a handle to the same storage instead of a pickled copy.
+        """
+        tensor.share_memory_()
+        setattr(self, name, tensor)
+        return tensor
+    
     @staticmethod
     def collate_fn(data, recursion=False):
         """
-        AcceptableType: dict，torch.Tensor, np.ndarray, int, float, bool, str, tuple, list
-        `dict` Type will always be processed recursively.
-        `torch.Tensor` and `np.ndarray` will be stacked as a batched ND-Tensor.
-        `int`, `float`, `bool` will be stacked as a batched 1D-Tensor.
-        `str` will be stacked as a batched list (TensorMisc.NotToCudaBatchList), which will not be on cuda later.
-        `list` will be simply stacked as a batched list (to support `Tensor` or `ndarray` of different shapes).
-        
-        NOTE 1: For `tuple`, please use `list` instead of `tuple` in data as `pin_memory=True` will convert all tuples to lists
-        
-        NOTE 2: If you are sure that the elements are not needed to be on cuda later, 
-            try to use `TensorMisc.NotToCudaBatchList` instead of `list` in `__getitem__` function of your Dataset class,
-            This could speedup `TensorMisc.to` a little bit.
-        
-        data (recursion=False): 
-            list(
-                [0] dict{
-                    'a': AcceptableType,
-                    'b': AcceptableType,
-                    'c': dict{
-                        'x': AcceptableType,
-                        'y': dict{...},
-                        }
-                    }
-                [1] ...
-                ), len(data) = batch_size       
-        which means the '__getitem__' of dataset should return a dict, whose values are AcceptableType
+        The default collate_fn (see `_DefaultCollateFn.__call__` for the AcceptableTypes), override it in a subclass to use a custom one.
+        `batch['batch_size']` is only set if not recursion.
+        NOTE: called directly, the schema is compiled for every call. The dataloaders use one `_DefaultCollateFn` each instead, see `get_collate_fn`.
         """
-        batch = dict()
-        for k, v in data[0].items():
-            if isinstance(v, dict):
-                # recursion
-                batch[k] = DataModuleBase.collate_fn(list(map(lambda d: d[k], data)), recursion=True)
-            elif isinstance(v, torch.Tensor):
-                # every d in data, get d[k]: `Tensor` to form a list, then stack them as a batched ND-Tensor
-                batch[k] = torch.stack(list(map(lambda d: d[k], data)), dim=0)
-            elif isinstance(v, np.ndarray):
-                # every d in data, get d[k]: `ndarray` to form a list of Tensors, then stack them as a batched ND-Tensor
-                batch[k] = torch.stack(list(map(lambda d: torch.as_tensor(d[k]), data)), dim=0)
-            elif isinstance(v, (int, float, bool)):
-                # every d in data, get d[k]: `(int, float, bool)` to form a batched 1D-Tensor
-                batch[k] = torch.as_tensor(list(map(lambda d: d[k], data)))
-            elif isinstance(v, (str, TensorMisc.NotToCudaBatchList)):
-                # every d in data, get d[k]: `(str, TensorMisc.NotToCudaBatchList)` to form a NotToCudaBatchList, which will not be on cuda later
-                batch[k] = TensorMisc.NotToCudaBatchList(map(lambda d: d[k], data))
-            elif isinstance(v, list):
-                # every d in data, get d[k]: `list` to simply form a BatchList (to support `Tensor` or `ndarray` of different shapes)
-                batch[k] = TensorMisc.BatchList(map(lambda d: d[k], data))
-            elif isinstance(v, tuple):
-                raise TypeError(f'Please use `list` instead of `tuple` in data as `pin_memory=True` will convert all tuples to lists')
-            else:
-                raise NotImplementedError(f'DataModuleBase.collate_fn not implemented for Type: {type(v)} of Element: {v}')
-        if not recursion:
-            batch['batch_size'] = len(data)
-        return batch  # batch: dataloader's output
+        batch = _DefaultCollateFn()(data)
+        if recursion:
+            del batch['batch_size']
+        return batch
+    
+    def get_collate_fn(self, split):
+        """
+        `self.collate_fn` if a subclass overrides it, otherwise one `_DefaultCollateFn` object for each dataloader (each split),
+        which keeps the compiled schema and holds no reference to the DataModule, so spawn-based workers do not pickle the whole DataModule (cfg, datasets of all splits, ...).
+        """
+        if type(self).collate_fn is not DataModuleBase.collate_fn:
+            return self.collate_fn
+        return _DefaultCollateFn()
     
     def get_dataloader(self, split: str):
         assert split in ['train', 'val', 'test'], f'Invalid split {split}'
@@ -128,7 +133,14 @@ class DataModuleBase:
                 )
         else:
             DataloaderClass = DataLoaderX
+        
+        if getattr(self.cfg.env, 'round_robin_samples', False):
+            assert DataloaderClass is DataLoaderX, 'env.round_robin_samples does not support fixed_length_trainloader or fixed_length_valloader'
+            DataloaderClass = RoundRobinDataLoaderX
             
+        # per-process numpy Generator for random ops in `__getitem__` (use `self.rng` instead of the global `np.random`), reseeded in each worker by `_worker_init_fn`
+        dataset.rng = np.random.default_rng(self._get_rank_seed())
+        
         batch_size = self.cfg.tester.tester_batch_size_per_rank if is_test else self.cfg.trainer.trainer_batch_size_per_rank
         if split=='val' and self.cfg.special.single_eval:
             batch_size = 1
@@ -136,49 +148,189 @@ class DataModuleBase:
         return DataloaderClass(
             dataset=dataset,
             batch_size=batch_size,
-            sampler=self.get_sampler(dataset, is_train, use_dist_sampler),
+            sampler=self.get_sampler(dataset, is_train, use_dist_sampler, generator=self.get_generator(split)),
             pin_memory=self.cfg.env.pin_memory,
-            collate_fn=self.collate_fn,
+            collate_fn=self.get_collate_fn(split),
             num_workers=self.cfg.env.num_workers,
             worker_init_fn=self.get_worker_init_fn(),
-            generator=self.get_generator(),
-            prefetch_factor=self.cfg.env.prefetch_factor if self.cfg.env.num_workers > 0 else None,
+            generator=self.get_generator(split),
+            # native per-worker prefetching (DDP-safe), no need for a `prefetch_generator.BackgroundGenerator` style wrapper
+            prefetch_factor=getattr(self.cfg.env, 'prefetch_factor', 4) if self.cfg.env.num_workers > 0 else None,
             persistent_workers=True if self.cfg.env.num_workers > 0 else False,
             drop_last=is_train,
+            worker_recycle_epochs=getattr(self.cfg.env, 'worker_recycle_epochs', 0),
         )
     
     @staticmethod
-    def _worker_init_fn(worker_id, rank_seed):
+    def pack_str_list(str_list):
+        """
+        Pack a list of str (e.g. file paths kept in a Dataset) into one fixed-width numpy unicode array.
+        Items of a Python list are separate objects whose refcounts are written on every access, so the copy-on-write pages shared with
+        the workers are copied over time (worker memory keeps growing with `persistent_workers=True`). One numpy buffer holds no Python objects.
+        NOTE: `np.array(str_list, dtype=object)` does not help, it still holds the Python objects. Use `str(packed[index])` to read.
+        """
+        return np.array(str_list, dtype=np.str_)
+    
+    @staticmethod
+    def _worker_init_fn(worker_id, rank_seed, recycle_index=0):
             signal.signal(signal.SIGINT, signal.SIG_IGN)
             worker_seed = rank_seed + worker_id
+            if recycle_index > 0:  # workers restarted by `DataLoaderX.worker_recycle_epochs` should not replay the random streams of the first pass
+                worker_seed = int(np.random.SeedSequence([worker_seed, recycle_index]).generate_state(1)[0])
             random.seed(worker_seed)
             np.random.seed(worker_seed)
+            # each worker has its own copy of the dataset, so `dataset.rng` will not give the same augmentations in different workers
+            torch.utils.data.get_worker_info().dataset.rng = np.random.default_rng(worker_seed)
+    
+    def _get_rank_seed(self):
+        return self.cfg.seed_base + self.cfg.env.num_workers * DistMisc.get_rank()
     
     def get_worker_init_fn(self):
-        return partial(DataModuleBase._worker_init_fn, rank_seed=self.cfg.seed_base + self.cfg.env.num_workers * DistMisc.get_rank())
+        return partial(DataModuleBase._worker_init_fn, rank_seed=self._get_rank_seed())
     
-    def get_sampler(self, dataset: Dataset, is_training: bool, use_dist_sampler: bool) -> Sampler:
+    def get_sampler(self, dataset: Dataset, is_training: bool, use_dist_sampler: bool, generator=None) -> Sampler:
         if self.cfg.env.distributed and use_dist_sampler:
-            sampler = distributed.DistributedSampler(dataset, shuffle=is_training)
+            # same seed on all ranks, which is required by DistributedSampler to split the same permutation
+            sampler = distributed.DistributedSampler(dataset, shuffle=is_training, seed=self.cfg.seed_base)
         else:
             if is_training:
-                sampler = RandomSampler(dataset)
+                sampler = RandomSampler(dataset, generator=generator)
             else:
                 sampler = SequentialSampler(dataset)
         return sampler
     
+    def get_generator(self, split):
+        if split not in self._generators:
+            g = torch.Generator()
+            g.manual_seed(self.cfg.seed_base + DistMisc.get_rank())
+            self._generators[split] = g
+        return self._generators[split]
+    
+    
+class _DefaultCollateFn:
+    """
+    The default collate_fn of DataModuleBase (see `__call__`), used if `DataModuleBase.collate_fn` is not overridden.
+    A module-level class, so it is pickled by its qualified name plus the schema only.
+    """
+    def __init__(self):
+        self.schema = None  # compiled from the first sample (in each worker)
+    
     @staticmethod
-    def get_generator():
-        g = torch.Generator()
-        g.manual_seed(0)
-        return g
+    def _compile_schema(sample, path=()):
+        """
+        Walk one sample (a nested dict) once and flatten it into a list of (path, kind), in the original key order.
+        `path` is a tuple of keys from the top-level dict to the element, `kind` decides how the element is batched.
+        A 'dict' entry is always placed before the entries of its children, so the nested dict can be rebuilt in order.
+        """
+        schema = []
+        for k, v in sample.items():
+            if isinstance(v, dict):
+                schema.append((path + (k,), 'dict'))
+                schema.extend(_DefaultCollateFn._compile_schema(v, path + (k,)))
+            elif isinstance(v, torch.Tensor):
+                schema.append((path + (k,), 'tensor'))
+            elif isinstance(v, np.ndarray):
+                schema.append((path + (k,), 'ndarray'))
+            elif isinstance(v, (int, float, bool)):
+                schema.append((path + (k,), 'number'))
+            elif isinstance(v, (str, TensorMisc.NotToCudaBatchList)):
+                schema.append((path + (k,), 'not_to_cuda'))
+            elif isinstance(v, list):
+                schema.append((path + (k,), 'list'))
+            elif isinstance(v, tuple):
+                raise TypeError(f'Please use `list` instead of `tuple` in data as `pin_memory=True` will convert all tuples to lists')
+            else:
+                raise NotImplementedError(f'_DefaultCollateFn not implemented for Type: {type(v)} of Element: {v}')
+        return schema
     
+    @staticmethod
+    def _get_by_path(d, path):
+        for k in path:
+            d = d[k]
+        return d
     
+    def __call__(self, data):
+        """
+        AcceptableType: dict，torch.Tensor, np.ndarray, int, float, bool, str, tuple, list
+        `dict` Type will always be processed recursively.
+        `torch.Tensor` and `np.ndarray` will be stacked as a batched ND-Tensor.
+        `int`, `float`, `bool` will be stacked as a batched 1D-Tensor.
+        `str` will be stacked as a batched list (TensorMisc.NotToCudaBatchList), which will not be on cuda later.
+        `list` will be simply stacked as a batched list (to support `Tensor` or `ndarray` of different shapes).
+        
+        NOTE 1: For `tuple`, please use `list` instead of `tuple` in data as `pin_memory=True` will convert all tuples to lists
+        
+        NOTE 2: If you are sure that the elements are not needed to be on cuda later, 
+            try to use `TensorMisc.NotToCudaBatchList` instead of `list` in `__getitem__` function of your Dataset class,
+            This could speedup `TensorMisc.to` a little bit.
+        
+        NOTE 3: The structure (keys and Types) of data is compiled into a flat schema from the first sample,
+            and reused for all later batches, so all samples of one dataloader should share the same structure.
+        
+        data: 
+            list(
+                [0] dict{
+                    'a': AcceptableType,
+                    'b': AcceptableType,
+                    'c': dict{
+                        'x': AcceptableType,
+                        'y': dict{...},
+                        }
+                    }
+                [1] ...
+                ), len(data) = batch_size       
+        which means the '__getitem__' of dataset should return a dict, whose values are AcceptableType
+        """
+        if self.schema is None:
+            self.schema = _DefaultCollateFn._compile_schema(data[0])
+        
+        get_by_path = _DefaultCollateFn._get_by_path
+        batch = dict()
+        nodes = {(): batch}
+        for path, kind in self.schema:
+            if kind == 'dict':
+                nodes[path] = nodes[path[:-1]][path[-1]] = dict()
+                continue
+            values = [get_by_path(d, path) for d in data]
+            if kind == 'tensor':
+                # `Tensor`s are stacked as a batched ND-Tensor
+                value = torch.stack(values, dim=0)
+            elif kind == 'ndarray':
+                # `ndarray`s are converted to Tensors, then stacked as a batched ND-Tensor
+                value = torch.stack([torch.as_tensor(v) for v in values], dim=0)
+            elif kind == 'number':
+                # `(int, float, bool)` form a batched 1D-Tensor
+                value = torch.as_tensor(values)
+            elif kind == 'not_to_cuda':
+                # `(str, TensorMisc.NotToCudaBatchList)` form a NotToCudaBatchList, which will not be on cuda later
+                value = TensorMisc.NotToCudaBatchList(values)
+            else:
+                # `list`s simply form a BatchList (to support `Tensor` or `ndarray` of different shapes)
+                value = TensorMisc.BatchList(values)
+            nodes[path[:-1]][path[-1]] = value
+        batch['batch_size'] = len(data)
+        return batch  # batch: dataloader's output
+
+
 class DataLoaderX(DataLoader):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, worker_recycle_epochs=0, **kwargs):
         super().__init__(*args, **kwargs)
         self.init_args = args
         self.init_kwargs = kwargs
+        self.init_kwargs['worker_recycle_epochs'] = worker_recycle_epochs
+        # > 0: restart persistent workers every N passes over the dataloader, to release their grown memory
+        # NOTE: the restarted workers call `worker_init_fn(worker_id, recycle_index=k)` (k-th restart), so it can reseed them
+        self.worker_recycle_epochs = worker_recycle_epochs
+        self._iter_count = 0
+        
+    def __iter__(self):
+        if self.worker_recycle_epochs > 0 and self._iterator is not None and self._iter_count % self.worker_recycle_epochs == 0:
+            self._iterator._shutdown_workers()
+            self._iterator = None
+            if self.init_kwargs.get('worker_init_fn') is not None:
+                self.worker_init_fn = partial(self.init_kwargs['worker_init_fn'], recycle_index=self._iter_count // self.worker_recycle_epochs)
+        self._iter_count += 1
+        return super().__iter__()
         
     def reinit_batch_size(self, batch_size):
         if 'batch_size' in self.init_kwargs:
@@ -190,10 +342,120 @@ class DataLoaderX(DataLoader):
     def sampler_set_epoch(self, epoch):
         self._current_epoch = epoch
         
-        if self.sampler is not None:
+        if hasattr(self.sampler, 'set_epoch'):  # DistributedSampler, not RandomSampler or SequentialSampler
             self.sampler.set_epoch(self._current_epoch)
             
 
+class CudaPrefetcher:
+    """
+    Wraps a dataloader and copies the next batch to cuda on a side stream while the current batch is being computed.
+    Batches are yielded already on `device`, other attributes (dataset, batch_size, sampler_set_epoch, ...) are forwarded to the wrapped dataloader.
+    NOTE: use with `pin_memory=True`, otherwise the copy on the side stream is not asynchronous.
+    """
+    def __init__(self, loader: DataLoaderX, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream()
+        
+    def __len__(self):
+        return len(self.loader)
+    
+    def __getattr__(self, name):
+        if name == 'loader':  # not initialized yet
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+    
+    def reinit_batch_size(self, batch_size):
+        # not forwarded, the new dataloader should be wrapped again
+        return CudaPrefetcher(self.loader.reinit_batch_size(batch_size), self.device)
+    
+    @staticmethod
+    def _record_stream(data, stream):
+        # tensors are allocated on the side stream but used on the current stream, so their memory should not be reused before the current stream is done with them
+        if isinstance(data, dict):
+            for v in data.values():
+                CudaPrefetcher._record_stream(v, stream)
+        elif isinstance(data, torch.Tensor):
+            if data.is_cuda:
+                data.record_stream(stream)
+        elif isinstance(data, (list, TensorMisc.BatchList)) and not isinstance(data, TensorMisc.NotToCudaBatchList):  # TensorMisc.BatchList is a UserList, not a list
+            for d in data:
+                CudaPrefetcher._record_stream(d, stream)
+    
+    def _preload(self, loader_iter):
+        batch = next(loader_iter, None)
+        if batch is not None:
+            with torch.cuda.stream(self.stream):
+                batch = TensorMisc.to(batch, self.device, non_blocking=True)
+        return batch
+    
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        next_batch = self._preload(loader_iter)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            CudaPrefetcher._record_stream(batch, current_stream)
+            next_batch = self._preload(loader_iter)
+            yield batch
+            
+
+def _identity_collate_fn(sample):
+    return sample
+
+
+class RoundRobinDataLoaderX:
+    """
+    DataLoader assigns a whole batch to one worker, so every batch (also the first one) takes batch_size * time_per_sample there.
+    Here the workers fetch single samples (spread over all workers in turn), which are collated into batches in the main process.
+    Takes the same arguments as DataLoaderX, other attributes (dataset, sampler_set_epoch, ...) are forwarded to the sample-level dataloader.
+    NOTE: collating (and pinning) is done in the main process, so this only pays off for heavy samples (e.g. large 3D volumes).
+    """
+    def __init__(self, *args, batch_size, collate_fn, pin_memory=False, drop_last=False, prefetch_factor=None, **kwargs):
+        self.init_args = args
+        self.init_kwargs = dict(kwargs, collate_fn=collate_fn, pin_memory=pin_memory, drop_last=drop_last, prefetch_factor=prefetch_factor)
+        self.loader = DataLoaderX(
+            *args,
+            batch_size=None,
+            collate_fn=_identity_collate_fn,
+            pin_memory=False,
+            prefetch_factor=prefetch_factor * batch_size if prefetch_factor is not None else None,  # counted in samples here
+            **kwargs,
+            )
+        self.batch_size = batch_size
+        self.collate_fn = collate_fn
+        self.pin_memory = pin_memory
+        self.drop_last = drop_last
+        
+    def __len__(self):
+        num_samples = len(self.loader)
+        return num_samples // self.batch_size if self.drop_last else math.ceil(num_samples / self.batch_size)
+    
+    def __getattr__(self, name):
+        if name == 'loader':  # not initialized yet
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+    
+    def reinit_batch_size(self, batch_size):
+        # not forwarded, the sample-level dataloader has no batch_size (only its prefetch_factor depends on it)
+        return RoundRobinDataLoaderX(*self.init_args, batch_size=batch_size, **self.init_kwargs)
+    
+    def _collate(self, samples):
+        batch = self.collate_fn(samples)
+        return TensorMisc.pin_memory(batch) if self.pin_memory else batch
+    
+    def __iter__(self):
+        samples = []
+        for sample in self.loader:
+            samples.append(sample)
+            if len(samples) == self.batch_size:
+                yield self._collate(samples)
+                samples = []
+        if len(samples) > 0 and not self.drop_last:
+            yield self._collate(samples)
+
+
 class FixedLengthSampler:
     def __init__(self, raw_sampler_list, required_length):
         self.raw_sampler_list = raw_sampler_list
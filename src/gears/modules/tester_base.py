@@ -30,6 +30,7 @@ class TesterBase:
         self.cfg = cfg
         self.loggers = loggers
         self.model_only_mode = model_only_mode
+        self.is_main = DistMisc.is_main_process()  # fixed for the whole run, checked once here
         
         # prepare for data
         self.data_manager = DataManager(cfg, loggers) if not self.model_only_mode else None
@@ -72,6 +73,7 @@ class TesterBase:
         self.ema_container = ema_container  # still in train mode (inited in ModelManager)
         self.postprocessor = postprocessor
         self.device = device
+        self.non_blocking = self.cfg.env.pin_memory  # read in every iter, resolved once here
         
         self.model.set_infer_mode(True)
         
@@ -119,7 +121,7 @@ class TesterBase:
     
     def _get_pbar(self):
         # called in "before_inference"
-        if DistMisc.is_main_process():
+        if self.is_main:
             test_pbar = LoggerMisc.MultiTQDM(
                 total=self.test_len,
                 dynamic_ncols=True,
@@ -133,14 +135,14 @@ class TesterBase:
     
     def _load_model(self):
         # called in "before_inference"
-        checkpoint = torch.load(self.cfg.tester.checkpoint_path, map_location=self.device)
+        checkpoint = ModelMisc.load_checkpoint(self.cfg.tester.checkpoint_path, map_location=self.device)
         self.model.load_state_dict(checkpoint['model'])
         if self.ema_container is not None:
             assert 'ema_container' in checkpoint, 'checkpoint does not contain "ema_container".'
             self.ema_container.load_state_dict(checkpoint['ema_container'])
         # print(f'{config.mode} mode: Loading pth from', path)
         print(LoggerMisc.block_wrapper(f'Loading pth from {self.cfg.tester.checkpoint_path}\nbest_val_metrics {checkpoint.get("best_val_metrics", {})}\nlast_val_metrics {checkpoint.get("last_val_metrics", {})}', '>'))
-        if DistMisc.is_main_process():
+        if self.is_main:
             if 'epoch' in checkpoint.keys():
                 print('Epoch:', checkpoint['epoch'])
                 if hasattr(self.loggers, 'wandb_run'):
@@ -164,17 +166,17 @@ class TesterBase:
     def _after_inference(self, **kwargs):
         LoggerMisc.logging(self.loggers,  'infer', self.test_metrics, None)
         
-        if DistMisc.is_main_process():          
+        if self.is_main:          
             self.test_pbar.close()
     
     def _forward(self, batch: dict):
         time.sleep(self.breath_time)
         
-        batch: dict = TensorMisc.to(batch, self.device, non_blocking=self.cfg.env.pin_memory)
+        batch: dict = TensorMisc.to(batch, self.device, non_blocking=self.non_blocking)
         inputs: dict = batch['inputs']
         targets: dict = batch['targets']
         
-        with torch.no_grad():
+        with torch.inference_mode():
             with self.inference_autocast():
                 if self.ema_only:
                     assert self.ema_container is not None, 'ema_container is None when ema_only is True.'
@@ -224,15 +226,15 @@ class TesterBase:
         
     def _print_module_states(self, prefix):
         print(f'\n[{prefix}]')
-        DistMisc.avoid_print_mess()
-        print(f'\tRank {DistMisc.get_rank()}:', force=True)
-        print(f'\t\tOnline:', force=True)
-        self.model.print_states(prefix='\t\t\t')
-        self.criterion.print_states(prefix='\t\t\t')
-        if self.ema_container is not None:
-            print(f'\t\tEMA:', force=True)
-            self.ema_container.ema_model.print_states(prefix='\t\t\t')
-            self.ema_criterion.print_states(prefix='\t\t\t')
+        with DistMisc.rank_ordered_print():
+            print(f'\tRank {DistMisc.get_rank()}:', force=True)
+            print(f'\t\tOnline:', force=True)
+            self.model.print_states(prefix='\t\t\t')
+            self.criterion.print_states(prefix='\t\t\t')
+            if self.ema_container is not None:
+                print(f'\t\tEMA:', force=True)
+                self.ema_container.ema_model.print_states(prefix='\t\t\t')
+                self.ema_criterion.print_states(prefix='\t\t\t')
     
     def run(self):
         # prepare for 1. loading model; 2. progress bar
@@ -1,7 +1,10 @@
+import io
 import math
 import os
+import threading
 import time
 import warnings
+from collections import OrderedDict
 from copy import deepcopy
 from functools import partial
 from glob import glob
@@ -33,11 +36,13 @@ class TrainerBase:
         super().__init__()
         self.cfg = cfg
         self.loggers = loggers
+        self.is_main = DistMisc.is_main_process()  # fixed for the whole run, checked once here
         
         # prepare for data
         self.data_manager = DataManager(cfg, loggers)
         train_loader = self.data_manager.build_dataloader(split='train')
-        val_loader = self.data_manager.build_dataloader(split='val')
+        # only the ranks that evaluate need the val_loader (no dataset, workers and pinned buffers on the other ranks)
+        val_loader = self.data_manager.build_dataloader(split='val') if cfg.trainer.dist_eval or self.is_main else None
         
         # prepare for model, postprocessor
         self.model_manager = ModelManager(cfg, loggers)
@@ -50,6 +55,7 @@ class TrainerBase:
         criterion = self.criterion_manager.build_criterion()
         
         # model wrapper
+        model_without_ddp = ModelMisc.compile_wrapper(cfg, model_without_ddp)
         model = ModelMisc.ddp_wrapper(cfg, model_without_ddp)
         
         # prepare for optimizers, le_schedulers, and scalers (cuda auto mixed precision(amp)) if needed, all in the integrated_optimizers
@@ -76,7 +82,7 @@ class TrainerBase:
         postprocessor: None,
         criterion: CriterionBase,
         train_loader: DataLoaderX,
-        val_loader: DataLoaderX,
+        val_loader: Union[DataLoaderX, None],
         integrated_optimizers: List[IntegratedOptimizer],
         device: torch.device,
         ) -> None:
@@ -103,8 +109,12 @@ class TrainerBase:
         
         self.gradient_accumulation_steps = self.cfg.trainer.grad_accumulation
         self.do_gradient_accumulation = self.gradient_accumulation_steps > 1
+        # config values read in every iter, resolved once here
+        self.distributed = self.cfg.env.distributed
+        self.non_blocking = self.cfg.env.pin_memory
+        self.iter_log_interval = self.cfg.info.iter_log_freq * self.gradient_accumulation_steps  # <= 0 means no iter logging
         self.train_len = len(self.train_loader)
-        self.val_len = len(self.val_loader)
+        self.val_len = len(self.val_loader) if self.val_loader is not None else 0  # no val_loader on non-main ranks if not dist_eval
         
         self.trained_iters = 0
         self.total_epochs = self.cfg.trainer.epochs
@@ -131,6 +141,14 @@ class TrainerBase:
         self.checkpoint_keep_interval = self.cfg.trainer.checkpoint_keep_interval  # save the checkpoint every {checkpoint_keep_interval} epochs (keep all)
         if self.checkpoint_keep_interval > 0:
             os.makedirs(os.path.join(self.cfg.info.work_dir, 'checkpoint_keep_storage'), exist_ok=True)
+        self.checkpoint_paths = {}  # label ('last' or 'best') -> path of the saved checkpoint (None if not saved yet), globbed only once
+        self.async_checkpoint = getattr(self.cfg.trainer, 'async_checkpoint', False) and self.device.type == 'cuda'  # stage to pinned buffers, write in a thread
+        self._checkpoint_stream = None
+        self._checkpoint_host_buffers = {}  # key path in save_dict -> reused (pinned) host tensor
+        self._checkpoint_thread = None
+        self._checkpoint_thread_result = {}
+        self._checkpoint_model_states = None  # (epoch, host copy of model/EMA states, staged event or None), see "_get_model_states"
+        self.use_grad_scaler = any(integrated_optimizer.scaler is not None for integrated_optimizer in self.integrated_optimizers)  # only for fp16 amp
         self.breath_time = self.cfg.trainer.trainer_breath_time  # XXX: avoid cpu being too busy
         self._init_autocast()
     
@@ -179,7 +197,7 @@ class TrainerBase:
     
     def _get_pbar(self):
         # called in "before_all_epochs"
-        if DistMisc.is_main_process():
+        if self.is_main:
             epoch_finished = self.start_epoch - 1
             train_pbar = LoggerMisc.MultiTQDM(
                 total=self.total_iters if self.cfg.info.global_tqdm else self.train_len,
@@ -210,7 +228,8 @@ class TrainerBase:
             checkpoint_path = glob(os.path.join(self.cfg.info.work_dir, 'checkpoint_last_epoch_*.pth'))
             print(LoggerMisc.block_wrapper(f'loading the checkpoint from {checkpoint_path}', '>'))
             assert len(checkpoint_path) == 1, f'Found {len(checkpoint_path)} checkpoints, please check.'
-            checkpoint = torch.load(checkpoint_path[0], map_location='cpu')
+            self.checkpoint_paths['last'] = checkpoint_path[0]
+            checkpoint = ModelMisc.load_checkpoint(checkpoint_path[0], map_location='cpu')
             self.model_without_ddp.load_state_dict(checkpoint['model'])
             if self.ema_container is not None:
                 assert 'ema_container' in checkpoint, 'checkpoint does not contain "ema_container".'
@@ -218,7 +237,7 @@ class TrainerBase:
             for integrated_optimizer in self.integrated_optimizers:
                 integrated_optimizer.load_state_dict(checkpoint[f'integrated_optimizer_{integrated_optimizer.identifier}'])
             self.start_epoch = checkpoint['epoch'] + 1
-            if DistMisc.is_main_process():
+            if self.is_main:
                 self.best_val_metrics = checkpoint.get('best_val_metrics', {})
                 self.last_val_metrics = checkpoint.get('last_val_metrics', {})
             self.trained_iters = checkpoint['epoch'] * self.train_len
@@ -236,7 +255,7 @@ class TrainerBase:
         
         def _load_pretrained_model(model_path, pretrain_model_name):
             if self.cfg.trainer.load_from_ema:  # use state_dict[EMA] to load
-                checkpoint = torch.load(model_path, map_location='cpu')
+                checkpoint = ModelMisc.load_checkpoint(model_path, map_location='cpu')
                 key = 'ema_container'
                 assert key in checkpoint, f'checkpoint does not contain "{key}", but "load_from_ema" is True.'
                 
@@ -267,7 +286,7 @@ class TrainerBase:
                 print(f'\nLoading {pretrain_model_name} (key="model") from {model_path}')
                 ModelMisc.load_state_dict_with_more_info(
                     self.model_without_ddp,
-                    torch.load(model_path, map_location='cpu')['model'],
+                    ModelMisc.load_checkpoint(model_path, map_location='cpu')['model'],
                     strict=False,
                     print_keys_level=1,
                     )
@@ -283,44 +302,158 @@ class TrainerBase:
                     _load_pretrained_model(pretrained_model_path, pretrain_model_name)
     
     @staticmethod
-    def _save_or_update_checkpoint(save_dict, work_dir, epoch_finished, label):
+    def _serialize_checkpoint(save_dict) -> io.BytesIO:
+        # serialize in memory once (torch.save already writes tensor storages as raw bytes), the bytes can then be written to several files
+        buffer = io.BytesIO()
+        torch.save(save_dict, buffer)
+        return buffer
+    
+    @staticmethod
+    def _write_checkpoint(checkpoint_buffer: io.BytesIO, path):
+        # one large sequential write instead of many small ones
+        with open(path, 'wb') as f:
+            f.write(checkpoint_buffer.getbuffer())
+    
+    def _get_saved_checkpoint_path(self, work_dir, label):
+        # label: 'last' or 'best'
+        if label not in self.checkpoint_paths:
+            checkpoint_path_list = glob(os.path.join(work_dir, f'checkpoint_{label}_epoch_*.pth'))
+            if len(checkpoint_path_list) > 1:
+                warnings.warn(f'Found {len(checkpoint_path_list)} {label} checkpoints, please check.')
+            max_saved_temp_epoch = max([int(os.path.basename(checkpoint_path).split('_')[-1].split('.')[0]) for checkpoint_path in checkpoint_path_list] + [0])
+            self.checkpoint_paths[label] = os.path.join(work_dir, f'checkpoint_{label}_epoch_{max_saved_temp_epoch}.pth') if max_saved_temp_epoch > 0 else None
+        return self.checkpoint_paths[label]
+    
+    def _save_or_update_checkpoint(self, checkpoint_buffer, work_dir, epoch_finished, label):
         # label: 'last' or 'best'
-        checkpoint_path_list = glob(os.path.join(work_dir, f'checkpoint_{label}_epoch_*.pth'))
-        if len(checkpoint_path_list) > 1:
-            warnings.warn(f'Found {len(checkpoint_path_list)} {label} checkpoints, please check.')
-        max_saved_temp_epoch = max([int(os.path.basename(checkpoint_path).split('_')[-1].split('.')[0]) for checkpoint_path in checkpoint_path_list] + [0])
+        old_path = self._get_saved_checkpoint_path(work_dir, label)
         new_path = os.path.join(work_dir, f'checkpoint_{label}_epoch_{epoch_finished}.pth')
-        if max_saved_temp_epoch == 0:
-            torch.save(save_dict, new_path)
+        # write to a temp file and then replace atomically, so an interruption never leaves a half-written checkpoint behind
+        self._write_checkpoint(checkpoint_buffer, new_path + '.tmp')
+        os.replace(new_path + '.tmp', new_path)
+        if old_path is not None and old_path != new_path and os.path.exists(old_path):
+            os.remove(old_path)
+        self.checkpoint_paths[label] = new_path
+    
+    @staticmethod
+    def _map_checkpoint_tensors(data, tensor_fn, key_path=()):
+        # apply tensor_fn(tensor, key_path) to all tensors in a (nested) save_dict, keeping the structure
+        if isinstance(data, torch.Tensor):
+            return tensor_fn(data, key_path)
+        elif isinstance(data, dict):
+            mapped = {k: TrainerBase._map_checkpoint_tensors(v, tensor_fn, key_path + (k,)) for k, v in data.items()}
+            if isinstance(data, OrderedDict):  # state_dict, keep its `_metadata` (versions of modules)
+                mapped = OrderedDict(mapped)
+                if hasattr(data, '_metadata'):
+                    mapped._metadata = data._metadata
+            return mapped
+        elif isinstance(data, (list, tuple)):
+            return type(data)(TrainerBase._map_checkpoint_tensors(v, tensor_fn, key_path + (i,)) for i, v in enumerate(data))
         else:
-            old_path = os.path.join(work_dir, f'checkpoint_{label}_epoch_{max_saved_temp_epoch}.pth')
-            torch.save(save_dict, old_path)
-            os.rename(old_path, new_path)
+            return data
+    
+    def _copy_to_checkpoint_host_buffer(self, tensor, key_path):
+        buffer = self._checkpoint_host_buffers.get(key_path)
+        if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+            buffer = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+            self._checkpoint_host_buffers[key_path] = buffer
+        buffer.copy_(tensor, non_blocking=True)  # also copies cpu tensors (e.g. optimizer steps), which may be updated in place later
+        return buffer
+    
+    def _stage_checkpoint(self, save_dict):
+        """
+        Copy all tensors in save_dict to reused pinned host buffers on a side stream.
+        The current stream waits (on the GPU) for the copies, so the next training steps cannot update the params before they are copied,
+        while the host goes on immediately.
+        """
+        if self._checkpoint_stream is None:
+            self._checkpoint_stream = torch.cuda.Stream()
+        self._checkpoint_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self._checkpoint_stream):
+            staged_dict = self._map_checkpoint_tensors(save_dict, self._copy_to_checkpoint_host_buffer)
+        staged_event = torch.cuda.Event()
+        staged_event.record(self._checkpoint_stream)
+        torch.cuda.current_stream().wait_event(staged_event)
+        return staged_dict, staged_event
+    
+    def _get_model_states(self, epoch_finished):
+        """
+        Host copy of the model (and EMA) states, shared by the "last"/"keep" and the "best" saving of the same epoch
+        (params are not changed by the validation in between), so they are copied from the device only once per epoch.
+        It is only kept until the "best" saving if this epoch has a validation.
+        """
+        if self._checkpoint_model_states is not None and self._checkpoint_model_states[0] == epoch_finished:
+            return self._checkpoint_model_states[1:]
+        
+        self._wait_for_checkpoint_saving()  # the host buffers may still be in use
+        model_states = {
+            'model': self.model_without_ddp.state_dict(),
+            'ema_container': self.ema_container.state_dict() if self.ema_container is not None else None,
+        }
+        if self.async_checkpoint:
+            model_states, staged_event = self._stage_checkpoint(model_states)
+        else:
+            model_states, staged_event = self._map_checkpoint_tensors(model_states, lambda tensor, _: tensor.cpu()), None
+        if epoch_finished in self.val_epoch_list:
+            self._checkpoint_model_states = (epoch_finished, model_states, staged_event)
+        return model_states, staged_event
+    
+    def _wait_for_checkpoint_saving(self):
+        if self._checkpoint_thread is not None:
+            self._checkpoint_thread.join()
+            self._checkpoint_thread = None
+            if 'error' in self._checkpoint_thread_result:
+                raise self._checkpoint_thread_result.pop('error')
+    
+    def _save_maybe_async(self, epoch_finished, save_dict, save_fn):
+        # save_fn({**model_states, **save_dict}), in a background thread if async_checkpoint
+        model_states, model_staged_event = self._get_model_states(epoch_finished)
+        # only one saving at a time, as the host buffers are reused
+        self._wait_for_checkpoint_saving()
+        if not self.async_checkpoint:
+            save_fn({**model_states, **save_dict})
+            return
+        
+        staged_dict, staged_event = self._stage_checkpoint(save_dict)
+        
+        def _save_in_thread():
+            try:
+                model_staged_event.synchronize()
+                staged_event.synchronize()
+                save_fn({**model_states, **staged_dict})
+            except BaseException as e:
+                self._checkpoint_thread_result['error'] = e
+        
+        self._checkpoint_thread = threading.Thread(target=_save_in_thread, name='checkpoint_saving')
+        self._checkpoint_thread.start()
     
     def _save_checkpoint(self):
         # called in "after_one_epoch"
-        if DistMisc.is_main_process():
+        if self.is_main:
             epoch_finished = self.epoch
             save_last = epoch_finished % self.checkpoint_last_interval == 0
             save_keep = epoch_finished % self.checkpoint_keep_interval == 0 if self.checkpoint_keep_interval > 0 else False
             
             if save_last or save_keep:
-                save_dict = {
-                    'model': self.model_without_ddp.state_dict(),
-                    'ema_container': self.ema_container.state_dict() if self.ema_container is not None else None,
+                save_dict = {  # with 'model' and 'ema_container' from "_get_model_states"
                     **{f'integrated_optimizer_{integrated_optimizer.identifier}': integrated_optimizer.state_dict() for integrated_optimizer in self.integrated_optimizers},
                     'last_val_metrics': self.last_val_metrics,
                     'epoch': epoch_finished,
                 }
-            if save_last:
-                self._save_or_update_checkpoint(save_dict, self.cfg.info.work_dir, epoch_finished, 'last')
-            if save_keep:
-                keep_path = os.path.join(self.cfg.info.work_dir, f'checkpoint_keep_storage/checkpoint_keep_epoch_{epoch_finished}.pth')
-                torch.save(save_dict, keep_path)
+                
+                def _save(save_dict):
+                    checkpoint_buffer = self._serialize_checkpoint(save_dict)  # shared by 'last' and 'keep'
+                    if save_last:
+                        self._save_or_update_checkpoint(checkpoint_buffer, self.cfg.info.work_dir, epoch_finished, 'last')
+                    if save_keep:
+                        keep_path = os.path.join(self.cfg.info.work_dir, f'checkpoint_keep_storage/checkpoint_keep_epoch_{epoch_finished}.pth')
+                        self._write_checkpoint(checkpoint_buffer, keep_path)
+                
+                self._save_maybe_async(epoch_finished, save_dict, _save)
     
     def _save_checkpoint_only_best_model(self):
         # called in "after_validation"
-        if DistMisc.is_main_process():
+        if self.is_main:
             self.best_val_metrics, last_is_best = self.criterion.choose_best(
                 self.last_val_metrics, self.best_val_metrics
             )
@@ -328,13 +461,16 @@ class TrainerBase:
             epoch_finished = self.epoch
             
             if last_is_best:
-                save_dict = {
-                    'model': self.model_without_ddp.state_dict(),
-                    'ema_container': self.ema_container.state_dict() if self.ema_container is not None else None,
+                save_dict = {  # with 'model' and 'ema_container' from "_get_model_states"
                     'best_val_metrics': self.best_val_metrics,
                     'epoch': epoch_finished,
                 }
-                self._save_or_update_checkpoint(save_dict, self.cfg.info.work_dir, epoch_finished, 'best')
+                self._save_maybe_async(
+                    epoch_finished,
+                    save_dict,
+                    lambda save_dict: self._save_or_update_checkpoint(self._serialize_checkpoint(save_dict), self.cfg.info.work_dir, epoch_finished, 'best'),
+                    )
+            self._checkpoint_model_states = None  # the last user of this epoch's model states
     
     def _train_mode(self):
         # called in "before_one_epoch"
@@ -384,7 +520,7 @@ class TrainerBase:
         
         DistMisc.barrier()
 
-        if DistMisc.is_main_process():
+        if self.is_main:
             if self.cfg.info.global_tqdm:
                 self.train_pbar.unpause()
             else :
@@ -407,7 +543,7 @@ class TrainerBase:
     def _before_validation(self, **kwargs):
         DistMisc.barrier()
         
-        if DistMisc.is_main_process():
+        if self.is_main:
             self.val_pbar.unpause()
             
         self._eval_mode()
@@ -421,16 +557,17 @@ class TrainerBase:
         self._save_checkpoint_only_best_model()
     
     def _after_all_epochs(self, **kwargs):
+        self._wait_for_checkpoint_saving()
         DistMisc.barrier()
         
-        if DistMisc.is_main_process():
+        if self.is_main:
             self.train_pbar.close()
             self.val_pbar.close() 
     
     def _forward(self, batch: dict):
         time.sleep(self.breath_time)
         
-        batch: dict = TensorMisc.to(batch, self.device, non_blocking=self.cfg.env.pin_memory)
+        batch: dict = TensorMisc.to(batch, self.device, non_blocking=self.non_blocking)
         inputs: dict = batch['inputs']
         targets: dict = batch['targets']
         
@@ -441,7 +578,7 @@ class TrainerBase:
                 outputs = self.model(inputs)
                 loss_dict, metrics_dict = self.criterion(outputs, targets)
         else:
-            with torch.no_grad():
+            with torch.inference_mode():  # no autograd graph and no version counter bumps; eval outputs never reach backward
                 with self.val_autocast():
                     if not self.dist_eval and isinstance(self.model, torch.nn.parallel.DistributedDataParallel):
                         outputs = self.model.module(inputs)
@@ -458,6 +595,13 @@ class TrainerBase:
             
         return outputs, loss_dict, metrics_dict
     
+    def _ddp_no_sync_context(self):
+        # skip DDP's gradient all-reduce in the micro-steps (except the last one) of gradient accumulation
+        # the forward must also be inside, as DDP prepares for the reduction there
+        if self.distributed and self.do_gradient_accumulation and (self.step_count + 1) % self.gradient_accumulation_steps != 0:
+            return self.model.no_sync()
+        return DummyContextManager()
+    
     def _backward_and_step(self, loss_dict: Dict[str, torch.Tensor]):
         grad_norm_dict = {}
         def _backward():
@@ -480,7 +624,7 @@ class TrainerBase:
         
         for loss in loss_dict.values():
             if loss is not None:
-                if not math.isfinite(loss) and self.integrated_optimizer.scaler is None:
+                if not math.isfinite(loss) and not self.use_grad_scaler:
                     LoggerMisc.get_wandb_pid(kill_all=True)
                     raise ValueError(f'Rank {DistMisc.get_rank()}: Loss is {loss}, stopping training.')
         
@@ -525,16 +669,17 @@ class TrainerBase:
         first_iter = True
         for batch in mlogger.log_every(self.train_loader):
             
-            _, loss_dict, metrics_dict = self._forward(batch)
-            
-            mlogger.update_metrics(
-                sample_count=batch['batch_size'],
-                **self.lr_groups,
-                **loss_dict,
-                **metrics_dict,
-            )
-            
-            grad_norm_dict = self._backward_and_step(loss_dict)
+            with self._ddp_no_sync_context():
+                _, loss_dict, metrics_dict = self._forward(batch)
+                
+                mlogger.update_metrics(
+                    sample_count=batch['batch_size'],
+                    **self.lr_groups,
+                    **loss_dict,
+                    **metrics_dict,
+                )
+                
+                grad_norm_dict = self._backward_and_step(loss_dict)
             
             mlogger.update_metrics(
                 epoch=self.trained_iters / self.train_len,
@@ -543,8 +688,8 @@ class TrainerBase:
                 if grad_norm is not None:
                     mlogger.update_metrics(**{key: grad_norm})
             
-            if cfg.info.iter_log_freq > 0:
-                if self.trained_iters % (cfg.info.iter_log_freq * cfg.trainer.grad_accumulation) == 0:
+            if self.iter_log_interval > 0:
+                if self.trained_iters % self.iter_log_interval == 0:
                     LoggerMisc.logging(loggers, 'train_iter', mlogger.output_dict(no_avg_list=['all']), self.trained_iters)
             
             if first_iter:
@@ -585,17 +730,17 @@ class TrainerBase:
             mlogger.add_epoch_metrics(**self.ema_criterion.forward_epoch_metrics())
         self.last_val_metrics = mlogger.output_dict(sync=self.dist_eval, final_print=True)
         
-    def _print_module_states(self, prefix):
+    def _print_module_states(self, prefix, all_ranks=True):
         print(f'\n[{prefix}] epoch {self.epoch}:')
-        DistMisc.avoid_print_mess()
-        print(f'\tRank {DistMisc.get_rank()}:', force=True)
-        print(f'\t\tOnline:', force=True)
-        self.model_without_ddp.print_states(prefix='\t\t\t')
-        self.criterion.print_states(prefix='\t\t\t')
-        if self.ema_container is not None:
-            print(f'\t\tEMA:', force=True)
-            self.ema_container.ema_model.print_states(prefix='\t\t\t')
-            self.ema_criterion.print_states(prefix='\t\t\t')
+        with DistMisc.rank_ordered_print(collective=all_ranks):  # not collective if only the main process gets here
+            print(f'\tRank {DistMisc.get_rank()}:', force=True)
+            print(f'\t\tOnline:', force=True)
+            self.model_without_ddp.print_states(prefix='\t\t\t')
+            self.criterion.print_states(prefix='\t\t\t')
+            if self.ema_container is not None:
+                print(f'\t\tEMA:', force=True)
+                self.ema_container.ema_model.print_states(prefix='\t\t\t')
+                self.ema_criterion.print_states(prefix='\t\t\t')
     
     def run(self):
         # train and val
@@ -615,9 +760,9 @@ class TrainerBase:
                 
                 self._before_validation()
                 
-                if self.dist_eval or DistMisc.is_main_process():
+                if self.dist_eval or self.is_main:
                     if self.cfg.info.print_module_states:
-                        self._print_module_states('Eval')
+                        self._print_module_states('Eval', all_ranks=self.dist_eval)
                     self._evaluate()
                     
                 self._after_validation()
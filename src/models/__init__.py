@@ -17,7 +17,12 @@ class ModelManager(object):
         self.device = torch.device(cfg.env.device)
 
     def build_model(self, verbose=True) -> ModelBase: 
-        model: ModelBase = model_register.get(self.cfg.model.model_choice)(self.cfg).to(self.device)
+        if getattr(self.cfg.model, 'init_on_device', False):
+            with self.device:  # params (and buffers) are allocated on the device directly, no init on cpu + copy
+                model: ModelBase = model_register.get(self.cfg.model.model_choice)(self.cfg)
+            model = model.to(self.device)  # for tensors created explicitly on cpu (if any)
+        else:
+            model: ModelBase = model_register.get(self.cfg.model.model_choice)(self.cfg).to(self.device)
         
         if verbose:
             print('model built successfully.')
@@ -1,5 +1,10 @@
+import math
+from contextlib import nullcontext
+
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint as checkpoint
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 
 class ConvBlock(nn.Module):
@@ -7,11 +12,15 @@ class ConvBlock(nn.Module):
                  kernel_size=3, stride=1, padding=1):
         super().__init__()
         assert dimension in [2, 3], 'Unsupported dimension'
+        self.norm = norm
         ConvXd = nn.Conv2d if dimension == 2 else nn.Conv3d
         if norm == 'batch':
             NormXd = nn.BatchNorm2d if dimension == 2 else nn.BatchNorm3d
         elif norm == 'instance':
             NormXd = nn.InstanceNorm2d if dimension == 2 else nn.InstanceNorm3d
+        elif norm == 'group':
+            # no running stats and no cross-rank sync in DDP
+            NormXd = lambda num_channels: nn.GroupNorm(math.gcd(32, num_channels), num_channels)
         else:
             # XXX: if using other norm modules, bias may be needed in ConvXd
             raise NotImplementedError('Unsupported norm type')
@@ -30,13 +39,60 @@ class ConvBlock(nn.Module):
                 NormXd(out_channels),
                 )
 
+    @torch.no_grad()
+    def fuse(self):
+        """
+        Fold each (Conv, BatchNorm) pair into one Conv for inference. Only for eval mode, the model should not be trained after fusing.
+        BatchNorms are replaced by nn.Identity in place, so the indices in the Sequentials are kept (fused Convs get a bias, BatchNorm keys leave the state_dict).
+        """
+        assert not self.training, 'ConvBlock.fuse() should be called in eval mode'
+        if self.norm != 'batch':
+            return
+        pairs = [(self.conv_block, 0, 1), (self.conv_block, 3, 4)]
+        if self.res_in_block:
+            pairs.append((self.conv_res, 0, 1))
+        for seq, conv_idx, norm_idx in pairs:
+            if isinstance(seq[norm_idx], nn.Identity):  # already fused
+                continue
+            seq[conv_idx] = fuse_conv_bn_eval(seq[conv_idx], seq[norm_idx])
+            seq[norm_idx] = nn.Identity()
+
     def forward(self, x):
         x = self.conv_final_activation(self.conv_res(x) + self.conv_block(x)) if self.res_in_block else self.conv_final_activation(self.conv_block(x))
         return x
 
 
+def fuse_conv_blocks(module: nn.Module):
+    for m in module.modules():
+        if isinstance(m, ConvBlock):
+            m.fuse()
+    return module
+
+
+class _KeepBatchNormStats:
+    """
+    Context of the recomputation in `checkpoint.checkpoint` (see `UpSampling.forward`): the BatchNorms of `module` are run in train mode
+    once more there, so their running stats (and num_batches_tracked) are saved on enter and restored on exit, to be updated only once per step.
+    The outputs are the same, as train mode BatchNorm normalizes with the batch stats.
+    """
+    def __init__(self, module: nn.Module):
+        self.buffers = [
+            buffer for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)
+            for buffer in (m.running_mean, m.running_var, m.num_batches_tracked) if buffer is not None
+            ]
+
+    def __enter__(self):
+        self.saved = [buffer.clone() for buffer in self.buffers]
+
+    def __exit__(self, *args):
+        with torch.no_grad():
+            for buffer, saved in zip(self.buffers, self.saved):
+                buffer.copy_(saved)
+        self.saved = None
+
+
 class DownSampling(nn.Module):
-    def __init__(self, in_channels, out_channels, dimension, padding_mode='zeros', no_down_dim=None, res_in_block=True):
+    def __init__(self, in_channels, out_channels, dimension, padding_mode='zeros', no_down_dim=None, res_in_block=True, norm='batch'):
         super().__init__()
         assert dimension in [2, 3], 'Unsupported dimension'
         MaxPoolXd = nn.MaxPool2d if dimension == 2 else nn.MaxPool3d
@@ -50,17 +106,39 @@ class DownSampling(nn.Module):
         stride = kernel_size
         self.unet_down = nn.Sequential(
             MaxPoolXd(kernel_size=kernel_size, stride=stride),
-            ConvBlock(in_channels, out_channels, dimension, padding_mode=padding_mode, res_in_block=res_in_block)
+            ConvBlock(in_channels, out_channels, dimension, norm=norm, padding_mode=padding_mode, res_in_block=res_in_block)
         )
 
     def forward(self, x):
         return self.unet_down(x)
 
 
+class PixelShuffleXd(nn.Module):
+    """
+    [N, C * prod(scale_factor), *S] -> [N, C, *(S * scale_factor)]
+    Same channel order as nn.PixelShuffle, but also for 3D and different scale factors for each spatial dim.
+    """
+    def __init__(self, scale_factor):
+        super().__init__()
+        self.scale_factor = tuple(scale_factor)
+        dimension = len(self.scale_factor)
+        # [N, C, s1, s2, ..., S1, S2, ...] -> [N, C, S1, s1, S2, s2, ...]
+        self.permute_dims = [0, 1] + [d for i in range(dimension) for d in (2 + dimension + i, 2 + i)]
+
+    def forward(self, x):
+        N, C, *spatial = x.shape
+        x = x.view(N, C // math.prod(self.scale_factor), *self.scale_factor, *spatial).permute(self.permute_dims)
+        return x.reshape(N, C // math.prod(self.scale_factor), *[s * f for s, f in zip(spatial, self.scale_factor)])
+
+
 class UpSampling(nn.Module):
-    def __init__(self, in_channels, cat_channels, out_channels, dimension, use_conv_transpose, padding_mode='zeros', no_up_dim=None, res_in_block=True):
+    def __init__(self, in_channels, cat_channels, out_channels, dimension, use_conv_transpose, padding_mode='zeros', no_up_dim=None, res_in_block=True,
+                 use_pixel_shuffle=False, grad_checkpoint=False, norm='batch'):
         super().__init__()
+        self.grad_checkpoint = grad_checkpoint
         assert dimension in [2, 3], 'Unsupported dimension'
+        assert not (use_conv_transpose and use_pixel_shuffle), 'use_conv_transpose and use_pixel_shuffle cannot be both True'
+        ConvXd = nn.Conv2d if dimension == 2 else nn.Conv3d
         ConvTransposeXd = nn.ConvTranspose2d if dimension == 2 else nn.ConvTranspose3d
         kernel_size = [2] * dimension
         if no_up_dim is not None:
@@ -72,15 +150,28 @@ class UpSampling(nn.Module):
         stride = kernel_size
         if use_conv_transpose:
             self.up = ConvTransposeXd(in_channels, in_channels, kernel_size=kernel_size, stride=stride)
+        elif use_pixel_shuffle:
+            # sub-pixel conv: a learnable 1x1 conv to (in_channels * prod(kernel_size)) channels, then a free reshape, instead of the memory-bound interpolation
+            self.up = nn.Sequential(
+                ConvXd(in_channels, in_channels * math.prod(kernel_size), kernel_size=1),
+                PixelShuffleXd(kernel_size),
+                )
         else:
             self.up = nn.Upsample(scale_factor=kernel_size, mode='bilinear' if dimension == 2 else 'trilinear', align_corners=True)
-        self.conv = ConvBlock(in_channels + cat_channels, out_channels, dimension, padding_mode=padding_mode, res_in_block=res_in_block)
+        self.conv = ConvBlock(in_channels + cat_channels, out_channels, dimension, norm=norm, padding_mode=padding_mode, res_in_block=res_in_block)
+
+    def _cat_conv(self, x, cat_features):
+        return self.conv(torch.cat([x, cat_features], dim=1))
 
     def forward(self, x, cat_features=None):
         x = self.up(x)
-        if cat_features is not None:
-            x = torch.cat([x, cat_features], dim=1)
-        return self.conv(x)
+        if cat_features is None:
+            return self.conv(x)
+        if self.grad_checkpoint and self.training:
+            # the concatenated tensor and the activations in self.conv are not kept for backward, but recomputed
+            return checkpoint.checkpoint(self._cat_conv, x, cat_features, use_reentrant=False,
+                                         context_fn=lambda: (nullcontext(), _KeepBatchNormStats(self.conv)))
+        return self._cat_conv(x, cat_features)
 
 
 class LastConv(nn.Module):
@@ -95,39 +186,44 @@ class LastConv(nn.Module):
 
 
 class UNetXd(nn.Module):
-    def __init__(self, in_channels, layer_out_channels=[64, 128, 256, 512], final_out_channels=None, dimension=2, use_conv_transpose=False, padding_mode='zeros', res_in_block=True):
+    def __init__(self, in_channels, layer_out_channels=[64, 128, 256, 512], final_out_channels=None, dimension=2, use_conv_transpose=False, padding_mode='zeros', res_in_block=True,
+                 use_pixel_shuffle=False, grad_checkpoint=False, norm='batch'):
         super().__init__()
         assert dimension in [2, 3], 'Unsupported dimension'
         if final_out_channels is None:
             final_out_channels = in_channels
 
-        self.in_conv = ConvBlock(in_channels, layer_out_channels[0], dimension, padding_mode=padding_mode, res_in_block=res_in_block)
+        self.in_conv = ConvBlock(in_channels, layer_out_channels[0], dimension, norm=norm, padding_mode=padding_mode, res_in_block=res_in_block)
         self.down_layers = nn.ModuleList([
-            DownSampling(layer_out_channels[i], layer_out_channels[i + 1], dimension, padding_mode, res_in_block=res_in_block) for i in range(len(layer_out_channels) - 1)
+            DownSampling(layer_out_channels[i], layer_out_channels[i + 1], dimension, padding_mode, res_in_block=res_in_block, norm=norm) for i in range(len(layer_out_channels) - 1)
         ])
         self.up_layers = nn.ModuleList([
-            UpSampling(layer_out_channels[i], layer_out_channels[i - 1], layer_out_channels[i - 1], dimension, use_conv_transpose, padding_mode, res_in_block=res_in_block) for i in range(len(layer_out_channels) - 1, 0, -1)
+            UpSampling(layer_out_channels[i], layer_out_channels[i - 1], layer_out_channels[i - 1], dimension, use_conv_transpose, padding_mode, res_in_block=res_in_block,
+                       use_pixel_shuffle=use_pixel_shuffle, grad_checkpoint=grad_checkpoint, norm=norm) for i in range(len(layer_out_channels) - 1, 0, -1)
         ])
         self.out_conv = LastConv(layer_out_channels[0], final_out_channels, dimension)
 
+    def fuse(self):  # call after .eval(), for inference only
+        return fuse_conv_blocks(self)
+
     def forward(self, x):
         # down
-        down_out_list = []
-        down_out_list.append(self.in_conv(x))
-        for down_layer in self.down_layers:
-            down_out_list.append(down_layer(down_out_list[-1]))
+        down_out_list = [None] * (len(self.down_layers) + 1)
+        x = down_out_list[0] = self.in_conv(x)
+        for idx, down_layer in enumerate(self.down_layers):
+            x = down_out_list[idx + 1] = down_layer(x)
 
-        # up
-        x = down_out_list.pop()
-        for up_layer in self.up_layers:
-            x = up_layer(x, down_out_list.pop())
+        # up (x is the output of the last down_layer, i.e. down_out_list[-1])
+        for idx, up_layer in enumerate(self.up_layers):
+            x = up_layer(x, down_out_list[-2 - idx])
         x = self.out_conv(x)
         
         return x
 
 
 class TimeUpscaleUNet3d(nn.Module):
-    def __init__(self, in_channels, up_scale=4, layer_out_channels=[64, 128, 256], final_out_channels=None, use_conv_transpose=False, padding_mode='zeros', res_in_block=True):
+    def __init__(self, in_channels, up_scale=4, layer_out_channels=[64, 128, 256], final_out_channels=None, use_conv_transpose=False, padding_mode='zeros', res_in_block=True,
+                 depthwise_special_up=False):
         super().__init__()
         assert 2 ** (len(layer_out_channels) - 1) == up_scale, 'up_scale must be 2 ** (len(layer_out_channels) - 1)'
         kernel_size = (2, 1, 1)
@@ -140,31 +236,44 @@ class TimeUpscaleUNet3d(nn.Module):
         self.down_layers = nn.ModuleList([
             DownSampling(layer_out_channels[i], layer_out_channels[i + 1], 3, padding_mode, no_down_dim=2, res_in_block=res_in_block) for i in range(len(layer_out_channels) - 1)
         ])
-        self.special_up = nn.ModuleList([
-            nn.ConvTranspose3d(layer_out_channels[i],
-                            layer_out_channels[i],
-                            kernel_size=tuple((torch.tensor(kernel_size) ** (len(layer_out_channels) - 1 - i)).tolist()),
-                            stride=tuple((torch.tensor(stride) ** (len(layer_out_channels) - 1 - i)).tolist())
-                            ) for i in range(len(layer_out_channels) - 1)
-        ])
+        if depthwise_special_up:
+            # depthwise 1x1x1 conv + nearest replication along time: 1/C of the weights and FLOPs of the ConvTranspose3d (but the same weights for every upscaled frame)
+            # conv before upsampling is the same as after it for nearest replication, but on fewer frames
+            self.special_up = nn.ModuleList([
+                nn.Sequential(
+                    nn.Conv3d(layer_out_channels[i], layer_out_channels[i], kernel_size=1, groups=layer_out_channels[i]),
+                    nn.Upsample(scale_factor=tuple((torch.tensor(stride) ** (len(layer_out_channels) - 1 - i)).tolist()), mode='nearest'),
+                    ) for i in range(len(layer_out_channels) - 1)
+            ])
+        else:
+            self.special_up = nn.ModuleList([
+                nn.ConvTranspose3d(layer_out_channels[i],
+                                layer_out_channels[i],
+                                kernel_size=tuple((torch.tensor(kernel_size) ** (len(layer_out_channels) - 1 - i)).tolist()),
+                                stride=tuple((torch.tensor(stride) ** (len(layer_out_channels) - 1 - i)).tolist())
+                                ) for i in range(len(layer_out_channels) - 1)
+            ])
         self.up_layers = nn.ModuleList([
             UpSampling(layer_out_channels[i], layer_out_channels[i - 1], layer_out_channels[i - 1], 3, use_conv_transpose, padding_mode, res_in_block=res_in_block) for i in range(len(layer_out_channels) - 1, 0, -1)
         ])
         self.out_conv = LastConv(layer_out_channels[0], final_out_channels, 3)
 
+    def fuse(self):  # call after .eval(), for inference only
+        return fuse_conv_blocks(self)
+
     def forward(self, x):  # [N, 3, L_fused, h, w] -> [N, 3, L_all, h ,w]
         # down
-        cat_list = []
+        cat_list = [None] * len(self.down_layers)
         x = self.in_conv(x)  # [N, c1, L_fused, h, w]
-        cat_list.append(self.special_up[0](x))
+        cat_list[0] = self.special_up[0](x)
         for idx, down_layer in enumerate(self.down_layers):
             x = down_layer(x)
             if idx < len(self.down_layers) - 1:  # [N, c2, L_fused, h/2, w/2]
-                cat_list.append(self.special_up[idx + 1](x))
+                cat_list[idx + 1] = self.special_up[idx + 1](x)
 
         # up
-        for up_layer in self.up_layers:
-            x = up_layer(x, cat_list.pop())
+        for idx, up_layer in enumerate(self.up_layers):
+            x = up_layer(x, cat_list[-1 - idx])
         x = self.out_conv(x)
         
         return x
@@ -194,19 +303,22 @@ class TimeDownscaleUNet3d(nn.Module):
         ])
         self.out_conv = LastConv(layer_out_channels[0], final_out_channels, 3)
 
+    def fuse(self):  # call after .eval(), for inference only
+        return fuse_conv_blocks(self)
+
     def forward(self, x):  # [N, 3, L_all, h, w] -> [N, 3, L_fused, h ,w]
         # down
-        cat_list = []
+        cat_list = [None] * len(self.down_layers)
         x = self.in_conv(x)  # [N, c1, L_fused, h, w]
-        cat_list.append(self.special_down[0](x))
+        cat_list[0] = self.special_down[0](x)
         for idx, down_layer in enumerate(self.down_layers):
             x = down_layer(x)
             if idx < len(self.down_layers) - 1:  # [N, c2, L_fused, h/2, w/2]
-                cat_list.append(self.special_down[idx + 1](x))
+                cat_list[idx + 1] = self.special_down[idx + 1](x)
                 
         # up
-        for up_layer in self.up_layers:
-            x = up_layer(x, cat_list.pop())
+        for idx, up_layer in enumerate(self.up_layers):
+            x = up_layer(x, cat_list[-1 - idx])
         x = self.out_conv(x)
         
         return x
\ No newline at end of file
@@ -1,3 +1,4 @@
+import torch
 from torch import nn
 from torch.nn import functional as F
 
@@ -44,12 +45,16 @@ class SimpleUNet2DModel(ModelBase):
     def __init__(self, cfg):
         super().__init__(cfg)
         if cfg.model.backbone == 'default':
-            self.backbone = UNetXd(in_channels=3, layer_out_channels=[64, 128, 256, 512, 1024], dimension=2)
+            self.backbone = UNetXd(in_channels=3, layer_out_channels=[64, 128, 256, 512, 1024], dimension=2, grad_checkpoint=self.do_grad_checkpoint)
         else:
             raise NotImplementedError(f'backbone "{cfg.model.backbone}" has not been implemented yet for {self.__class__}.')
         
+        # NHWC convolutions (tensor cores on cuda)
+        self.memory_format = torch.channels_last if cfg.model.channels_last else torch.contiguous_format
+        self.backbone = self.backbone.to(memory_format=self.memory_format)
+        
     def forward(self, inputs: dict) -> dict:
-        x = inputs['x']
+        x = inputs['x'].contiguous(memory_format=self.memory_format)
         x = self.backbone(x)
         return {
             'pred_y': x
@@ -61,12 +66,16 @@ class SimpleUNet3DModel(ModelBase):
     def __init__(self, cfg):
         super().__init__(cfg)
         if cfg.model.backbone == 'default':
-            self.backbone = UNetXd(in_channels=3, dimension=3)
+            self.backbone = UNetXd(in_channels=3, dimension=3, grad_checkpoint=self.do_grad_checkpoint)
         else:
             raise NotImplementedError(f'backbone "{cfg.model.backbone}" has not been implemented yet for {self.__class__}.')
+        
+        # NDHWC convolutions (tensor cores on cuda)
+        self.memory_format = torch.channels_last_3d if cfg.model.channels_last else torch.contiguous_format
+        self.backbone = self.backbone.to(memory_format=self.memory_format)
 
     def forward(self, inputs: dict) -> dict:
-        x = inputs['x']
+        x = inputs['x'].contiguous(memory_format=self.memory_format)
         x = self.backbone(x)
         return {
             'pred_y': x
@@ -90,7 +99,7 @@ class LeNet(ModelBase):
         x = F.max_pool2d(x, 2)
         x = F.silu(self.conv2(x))
         x = F.max_pool2d(x, 2)
-        x = x.view(-1, 16 * 4 * 4)
+        x = torch.flatten(x, 1)
         x = F.silu(self.fc1(x))
         x = F.silu(self.fc2(x))
         x = self.fc3(x)
@@ -119,7 +128,7 @@ class LeNetMultiOptimizer(ModelBase):
         x = F.max_pool2d(x, 2)
         x = F.silu(self.convs[1](x))
         x_conv_out = F.max_pool2d(x, 2)
-        x = x_conv_out.view(-1, 16 * 4 * 4).detach()
+        x = torch.flatten(x_conv_out, 1).detach()
         x = F.silu(self.fcs[0](x))
         x = F.silu(self.fcs[1](x))
         x = self.fcs[2](x)
@@ -168,7 +177,7 @@ class LeNetMultiOptimizerV2(ModelBase):
     def forward(self, inputs: dict) -> dict:
         x = inputs['x']
         x_conv_out = self.convs(x)
-        x = x_conv_out.view(-1, 16 * 4 * 4).detach()
+        x = torch.flatten(x_conv_out, 1).detach()
         x = self.fcs(x)
         return {
             'conv_out': x_conv_out,
@@ -1,14 +1,20 @@
 import importlib
+import inspect
+import io
 # import logging
 import os
+import pickle
 import random
 import shutil
 import signal
 import sys
 import time
 import warnings
+import weakref
 from collections import UserList, defaultdict
+from contextlib import contextmanager, redirect_stdout
 from copy import deepcopy
+from functools import reduce
 from glob import glob
 from math import inf
 from types import SimpleNamespace
@@ -123,14 +129,22 @@ class ConfigMisc:
     
     @staticmethod 
     def nested_dict_to_nested_namespace(dictionary, ignore_key_list=[]):
-        namespace = dictionary
-        if isinstance(dictionary, dict):
-            namespace = SimpleNamespace(**dictionary)
-            for key, value in dictionary.items():
+        if not isinstance(dictionary, dict):
+            return dictionary
+        # iterative, and each attribute is set only once
+        namespace = SimpleNamespace()
+        stack = [(namespace, dictionary)]
+        while stack:
+            namespace_now, dictionary_now = stack.pop()
+            for key, value in dictionary_now.items():
                 if key in ignore_key_list:
-                    delattr(namespace, key)
                     continue
-                setattr(namespace, key, ConfigMisc.nested_dict_to_nested_namespace(value, ignore_key_list))
+                if isinstance(value, dict):
+                    sub_namespace = SimpleNamespace()
+                    setattr(namespace_now, key, sub_namespace)
+                    stack.append((sub_namespace, value))
+                else:
+                    setattr(namespace_now, key, value)
         return namespace
     
     @staticmethod 
@@ -205,25 +219,19 @@ class ConfigMisc:
     @staticmethod
     def read_from_yaml(path):
         with open(path, 'r', encoding='utf-8') as f:
-            config = yaml.safe_load(f.read())
+            config = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))  # libyaml C bindings if available
         return ConfigMisc.nested_dict_to_nested_namespace(config)
     
     @staticmethod
     def write_to_yaml(path, config, ignore_name_list):
         with open(path, 'w', encoding='utf-8') as f:
-            yaml.safe_dump(ConfigMisc.nested_namespace_to_nested_dict(config, ignore_name_list), f)
+            yaml.dump(ConfigMisc.nested_namespace_to_nested_dict(config, ignore_name_list), f, Dumper=getattr(yaml, 'CSafeDumper', yaml.SafeDumper))
     
     @staticmethod
     def get_specific_list(cfg, cfg_keys):
-        def get_nested_attr(cfg, key):
-            if '.' in key:
-                key, subkey = key.split('.', 1)
-                return get_nested_attr(getattr(cfg, key), subkey)
-            else:
-                return getattr(cfg, key)
         specific_list = []
         for cfg_key in cfg_keys:
-            result = get_nested_attr(cfg, cfg_key)
+            result = reduce(getattr, cfg_key.split('.'), cfg)  # dotted key -> nested attribute
             if result is not None:
                 specific_list.append(str(result))
         return specific_list
@@ -371,6 +379,14 @@ class PortalMisc:
                 torch.backends.cudnn.deterministic = True
                 torch.backends.cudnn.benchmark = False
     
+    @staticmethod
+    def set_backend_flags(cfg):
+        # faster (but not bit-wise deterministic) cuda backends, skipped if "cuda_deterministic"
+        if cfg.env.device == 'cuda' and not getattr(cfg.env, 'cuda_deterministic', False):
+            torch.backends.cudnn.benchmark = getattr(cfg.env, 'cudnn_benchmark', False)
+            torch.backends.cudnn.allow_tf32 = getattr(cfg.env, 'tf32', True)
+            torch.set_float32_matmul_precision(getattr(cfg.env, 'matmul_precision', 'high'))  # 'high' means TF32 for matmuls
+    
     @staticmethod
     def special_config_adjustment(cfg):
         def _set_real_batch_size_and_lr(cfg):
@@ -403,7 +419,12 @@ class PortalMisc:
                                               f'{cfg.tester.tester_batch_size_total}={cfg.tester.tester_batch_size_per_rank}_{cfg.env.world_size}')
         
         _set_real_batch_size_and_lr(cfg)
-        
+
+        if cfg.env.num_workers == 'auto':  # split the CPUs of this node among its ranks, at most 8 workers per dataloader
+            num_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+            local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+            ConfigMisc.auto_track_setattr(cfg, ['env', 'num_workers'], max(1, min(num_cpus // local_world_size, 8)))
+
         if cfg.special.debug == 'one_iter':  # 'one_iter' debug mode
             ConfigMisc.auto_track_setattr(cfg, ['env', 'num_workers'], 0)
          
@@ -413,6 +434,12 @@ class PortalMisc:
             
         if cfg.special.single_eval:
             ConfigMisc.auto_track_setattr(cfg, ['trainer', 'dist_eval'], False)
+        
+        if cfg.amp.amp_mode == 'auto':  # bf16 (no GradScaler, no loss scaling syncs) on Ampere+ GPUs, else fp16
+            ConfigMisc.auto_track_setattr(cfg, ['amp', 'amp_mode'], 'bf16' if cfg.env.device == 'cuda' and torch.cuda.is_bf16_supported() else 'fp16')
+        
+        # the config is final from here on (except work_dir and start_time), so the name_tags are resolved once for the loggers
+        ConfigMisc.auto_track_setattr(cfg, ['info', 'name_tag_values'], ConfigMisc.get_specific_list(cfg, cfg.info.name_tags))
 
 
     @staticmethod
@@ -485,49 +512,65 @@ class PortalMisc:
                     
             return modified, str_pre, str_post
         
-        def write_config_lines(str_block_in, cfg_in, indent=0):
-            str_block_add = ''
-            for key in sorted(vars(cfg_in).keys()):
-                if key in cfg.special.print_save_config_ignore + ['modified_cfg_dict']:
-                    continue   
-                key_indent = ' ' * (4 * indent) + ' ├─ ' + key
-                value = getattr(cfg_in, key)
-                if isinstance(value, SimpleNamespace):
-                    str_block_add += write_config_lines(f'{key_indent}\n', value, indent + 1)
-                else:
-                    if len(key_indent) > 40:
-                        warnings.warn(f'Config key "{key}" with indent is too long (>40) to display, please check.')
-                    elif len(key_indent) < 38:
-                        key_indent += ' ' + '-' * (38 - len(key_indent)) + ' '
+        def write_leaf_line(key_indent, key, value):
+            if len(key_indent) > 40:
+                warnings.warn(f'Config key "{key}" with indent is too long (>40) to display, please check.')
+            elif len(key_indent) < 38:
+                key_indent += ' ' + '-' * (38 - len(key_indent)) + ' '
+            
+            ever_modified = False
+            str_add, final_str_pre = '', ''
+            for dict_key_prefix in dict_key_prefix_list:
+                modified, str_pre, str_post = check_modified_cfg_dict(modified_cfg_dict, key, value, dict_key_prefix=dict_key_prefix)         
+                if modified:
+                    ever_modified = True
+                    final_str_pre = f'{COLORS[modified]}{key_indent:40}{COLORS[UNCHANGED]}' + str_pre
+                    str_add = str_post + str_add
                     
-                    ever_modified = False
-                    str_add, final_str_pre = '', ''
-                    for dict_key_prefix in dict_key_prefix_list:
-                        modified, str_pre, str_post = check_modified_cfg_dict(modified_cfg_dict, key, value, dict_key_prefix=dict_key_prefix)         
-                        if modified:
-                            ever_modified = True
-                            final_str_pre = f'{COLORS[modified]}{key_indent:40}{COLORS[UNCHANGED]}' + str_pre
-                            str_add = str_post + str_add
-                            
-                    if not modified_config_only and not ever_modified:
-                        str_add = f'{key_indent:40}{value}\n'
-                    else:
-                        str_add = final_str_pre + str_add
-                        if str_add != '':
-                            str_add += '\n'
-                        
-                    str_block_add += str_add
-            if str_block_add != '':
-                return str_block_in + str_block_add
+            if not modified_config_only and not ever_modified:
+                str_add = f'{key_indent:40}{value}\n'
             else:
-                return ''
+                str_add = final_str_pre + str_add
+                if str_add != '':
+                    str_add += '\n'
+            return str_add
+        
+        def write_config_lines(str_block_in, cfg_in):
+            # iterative DFS; the header of a namespace is only written once something under it is written (same as before)
+            ignore_keys = set(cfg.special.print_save_config_ignore + ['modified_cfg_dict'])
+            parts = []
+            stack = [(iter(sorted(vars(cfg_in).items())), 0, str_block_in)]  # (items, indent, header)
+            headers_written = 0  # headers of stack[:headers_written] are already in parts
+            while stack:
+                items, indent, _ = stack[-1]
+                for key, value in items:
+                    if key in ignore_keys:
+                        continue
+                    key_indent = ' ' * (4 * indent) + ' ├─ ' + key
+                    if isinstance(value, SimpleNamespace):
+                        stack.append((iter(sorted(vars(value).items())), indent + 1, f'{key_indent}\n'))
+                        break
+                    str_add = write_leaf_line(key_indent, key, value)
+                    if str_add != '':
+                        parts.extend(header for _, _, header in stack[headers_written:])
+                        headers_written = len(stack)
+                        parts.append(str_add)
+                else:
+                    stack.pop()
+                    headers_written = min(headers_written, len(stack))
+            return ''.join(parts)
+        
+        if not force_all_rank and not DistMisc.is_main_process():
+            return
         
         str_block = f'Rank {DistMisc.get_rank()} --- {"Modified" if modified_config_only else "All"} Parameters: (\033[32madded, \033[34mmodified, \033[31mtypechanged)\033[0m\n'
         str_block = LoggerMisc.block_wrapper(write_config_lines(str_block, cfg), s='=', block_width=80)
         
-        DistMisc.avoid_print_mess()
-        print(str_block, force=force_all_rank)
-        DistMisc.avoid_print_mess()
+        if force_all_rank:
+            with DistMisc.rank_ordered_print():
+                print(str_block, force=True)
+        else:
+            print(str_block)
     
     @staticmethod 
     def init_loggers(cfg):
@@ -536,7 +579,7 @@ class PortalMisc:
             cfg_plain = ConfigMisc.nested_namespace_to_plain_namespace(cfg, cfg.special.logger_config_ignore + ['modified_cfg_dict'])
             if cfg.info.wandb.wandb_enabled:
                 import wandb
-                wandb_name = '_'.join(ConfigMisc.get_specific_list(cfg, cfg.info.name_tags))
+                wandb_name = '_'.join(cfg.info.name_tag_values)
                 wandb_name = f'[{cfg.info.task_type}] ' + wandb_name
                 wandb_tags = ConfigMisc.get_specific_list(cfg, cfg.info.wandb.wandb_tags)
                 if ConfigMisc.is_inference(cfg):
@@ -640,10 +683,24 @@ class DistMisc:
             dist.barrier()    
     
     @staticmethod
-    def avoid_print_mess(sleep_interval=0.1):
-        if DistMisc.is_dist_avail_and_initialized():  # 
-            dist.barrier()
-            time.sleep(DistMisc.get_rank() * sleep_interval)
+    @contextmanager
+    def rank_ordered_print(collective=True):
+        '''
+        Everything printed inside this context is captured on each rank, gathered to the main process and printed there in rank order.
+        One gather_object replaces the old barrier + (rank * 0.1s) sleep, which grew with the world size.
+        NOTE: this is a collective call, so all ranks must enter it.
+            If only some ranks get here (e.g. the main process only), use collective=False to print directly without gathering.
+        '''
+        if not collective or not DistMisc.is_dist_avail_and_initialized():
+            yield
+            return
+        buffer = io.StringIO()
+        with redirect_stdout(buffer):
+            yield
+        gathered_list = [None] * DistMisc.get_world_size() if DistMisc.is_main_process() else None
+        dist.gather_object(buffer.getvalue(), gathered_list, dst=0)
+        if DistMisc.is_main_process():
+            print(''.join(gathered_list), end='', flush=True)
     
     @staticmethod
     def all_gather(x, concat_out=False):
@@ -657,12 +714,24 @@ class DistMisc:
         if world_size == 1:
             x_list = [x]
         else:
-            N = torch.tensor(x.shape[0], dtype=torch.int, device=x.device)
-            N_list = [torch.zeros(1, dtype=torch.int, device=x.device) for _ in range(world_size)]
-            dist.all_gather(N_list, N)
+            # exchange all sizes into one tensor, then read them back with one sync instead of one `.item()` per rank
+            N = torch.tensor([x.shape[0]], dtype=torch.int64, device=x.device)
+            N_all = torch.empty(world_size, dtype=torch.int64, device=x.device)
+            dist.all_gather_into_tensor(N_all, N)
                 
-            x_list = [torch.empty(N.item(), *x.shape[1:], dtype=x.dtype, device=x.device) for N in N_list]
-            dist.all_gather(x_list, x)
+            N_list = N_all.tolist()
+            
+            # pad to the max N and gather into one tensor with a single collective (instead of an uneven list all_gather)
+            max_N = max(N_list)
+            if x.shape[0] < max_N:
+                x_padded = x.new_empty(max_N, *x.shape[1:])
+                x_padded[:x.shape[0]] = x
+                x = x_padded
+            x_all = x.new_empty(world_size, max_N, *x.shape[1:])
+            dist.all_gather_into_tensor(x_all, x.contiguous())
+            if concat_out and min(N_list) == max_N:
+                return x_all.flatten(0, 1)
+            x_list = [x_all[i, :n] for i, n in enumerate(N_list)]  # views, no copy
         
         if concat_out:
             return torch.cat(x_list, dim=0)
@@ -671,18 +740,31 @@ class DistMisc:
     
     @staticmethod
     def reduce_dict(input_dict, average=True):
+        '''
+        Values are packed into one flat tensor per dtype and device (so nothing is cast), with one all_reduce per flat tensor.
+        The returned tensors are views of these flat tensors, which are new in every call.
+        '''
         world_size = DistMisc.get_world_size()
         if world_size < 2:
             return input_dict
         with torch.inference_mode():
-            # sort the keys so that they are consistent across processes
+            # sort the keys so that they (and the order of the groups) are consistent across processes
             names = sorted(input_dict.keys())
-            values = torch.stack(list(map(lambda k: input_dict[k]), names), dim=0)
-            dist.all_reduce(values)
+            groups = {}  # (dtype, device) -> [key, ...]
+            for k in names:
+                groups.setdefault((input_dict[k].dtype, input_dict[k].device), []).append(k)
             if average:
-                values /= world_size
-            reduced_dict = {k: v for k, v in zip(names, values)}
-        return reduced_dict
+                assert all(dtype.is_floating_point for dtype, _ in groups), f'reduce_dict with average=True needs floating point values, but got {[dtype for dtype, _ in groups]}.'
+            
+            reduced_dict = {}
+            for group_names in groups.values():
+                flat_values = torch.cat([input_dict[k].reshape(-1) for k in group_names])
+                dist.all_reduce(flat_values)
+                if average:
+                    flat_values /= world_size
+                for k, v in zip(group_names, flat_values.split([input_dict[k].numel() for k in group_names])):
+                    reduced_dict[k] = v.view(input_dict[k].shape)
+        return {k: reduced_dict[k] for k in names}
     
     @staticmethod
     def reduce(tensor, op='mean'):
@@ -756,9 +838,8 @@ class DistMisc:
                 dist.init_process_group(
                     backend=cfg.env.dist_backend, init_method=cfg.env.dist_url, world_size=cfg.env.world_size, rank=cfg.env.rank
                 )
-                # DistMisc.avoid_print_mess()
-                # print(f'INFO - distributed init (Rank {cfg.env.rank}): {cfg.env.dist_url}')
-                # DistMisc.avoid_print_mess()
+                # with DistMisc.rank_ordered_print():
+                #     print(f'INFO - distributed init (Rank {cfg.env.rank}): {cfg.env.dist_url}', force=True)
             else:
                 ConfigMisc.auto_track_setattr(cfg, ['env', 'distributed'], False)
                 ConfigMisc.auto_track_setattr(cfg, ['env', 'world_size'], 1)
@@ -819,32 +900,36 @@ class ModelMisc:
     @staticmethod
     def show_model_info(cfg, trainer, torchinfo_columns=None):
         if DistMisc.is_main_process():
-            one_sample = trainer.train_loader.dataset[0]
-            one_sample_batch_input = TensorMisc.to(trainer.train_loader.collate_fn([one_sample])['inputs'], trainer.device)
-            whole_batch_input = TensorMisc.to(trainer.train_loader.collate_fn([one_sample] * cfg.trainer.trainer_batch_size_per_rank)['inputs'], trainer.device)
+            show_tensorboard_graph = hasattr(trainer.loggers, 'tensorboard_run') and cfg.info.tensorboard.tensorboard_graph
+            if not (show_tensorboard_graph or cfg.info.torchinfo or cfg.info.print_param_names):
+                return  # nothing to show, so no sample loading, collating and copying to the device
             
             temp_model = trainer.model_without_ddp
             temp_model.eval()
             
-            if hasattr(trainer.loggers, 'tensorboard_run'):
-                if cfg.info.tensorboard.tensorboard_graph:
-                    
-                    class WriterWrappedModel(torch.nn.Module):
-                        def __init__(self, model):
-                            super().__init__()
-                            self.model = model
-                            
-                        def forward(self, inputs):
-                            output_tensor_list = []
-                            for v in self.model(inputs).values():
-                                if isinstance(v, torch.Tensor):
-                                    output_tensor_list.append(v)
-                            return tuple(output_tensor_list)
+            if show_tensorboard_graph or cfg.info.torchinfo:
+                one_sample = trainer.train_loader.dataset[0]
+            
+            if show_tensorboard_graph:
+                one_sample_batch_input = TensorMisc.to(trainer.train_loader.collate_fn([one_sample])['inputs'], trainer.device)
+                
+                class WriterWrappedModel(torch.nn.Module):
+                    def __init__(self, model):
+                        super().__init__()
+                        self.model = model
                         
-                    trainer.loggers.tensorboard_run.add_graph(
-                        WriterWrappedModel(temp_model),
-                        one_sample_batch_input,
-                        )
+                    def forward(self, inputs):
+                        output_tensor_list = []
+                        for v in self.model(inputs).values():
+                            if isinstance(v, torch.Tensor):
+                                output_tensor_list.append(v)
+                        return tuple(output_tensor_list)
+                    
+                trainer.loggers.tensorboard_run.add_graph(
+                    WriterWrappedModel(temp_model),
+                    one_sample_batch_input,
+                    )
+                del one_sample_batch_input
             
             if cfg.info.torchinfo:
                 import torchinfo
@@ -858,6 +943,7 @@ class ModelMisc:
                     'trainable',
                     ]
                 assert cfg.trainer.trainer_batch_size_per_rank == trainer.train_loader.batch_size
+                whole_batch_input = TensorMisc.to(trainer.train_loader.collate_fn([one_sample] * cfg.trainer.trainer_batch_size_per_rank)['inputs'], trainer.device)
                 
                 class TorchinfoWrappedModel(torch.nn.Module):
                     def __init__(self, model):
@@ -867,7 +953,7 @@ class ModelMisc:
                     def forward(self, **inputs):
                         return self.model(inputs)
                 
-                with trainer.train_autocast():
+                with torch.no_grad(), trainer.train_autocast():  # no autograd graph (and its activations) for a shape-only forward
                     print_str = torchinfo.summary(
                         TorchinfoWrappedModel(temp_model),
                         input_data=whole_batch_input,
@@ -878,6 +964,7 @@ class ModelMisc:
                 # Check model info in OUTPUT_PATH/logs.log
                 print(print_str, file=trainer.loggers.log_file)    
                 print(LoggerMisc.block_wrapper(f'torchinfo: Model structure and summary have been saved.'))
+                del whole_batch_input
             
             if cfg.info.print_param_names:
                 print('\nAll Params:', file=trainer.loggers.log_file)
@@ -886,20 +973,69 @@ class ModelMisc:
                 print('\n', file=trainer.loggers.log_file)
                 
             trainer.loggers.log_file.flush()
-            del temp_model, one_sample, one_sample_batch_input, whole_batch_input
+            del temp_model
             torch.cuda.empty_cache()
     
+    @staticmethod
+    def compile_wrapper(cfg, model_without_ddp):
+        # compiled in place, so model_without_ddp (shared with optimizers, EMA and checkpoints) and its state_dict keys stay the same
+        # optimizer.zero_grad() and step() stay outside the compiled region
+        compile_mode = getattr(cfg.trainer, 'compile_mode', 'default')
+        compile_regions = getattr(cfg.trainer, 'compile_regions', [])
+        if compile_regions:
+            # regional compile: the repeated blocks share the same code, so one compilation is reused by all of them
+            for region_name in compile_regions:
+                region = model_without_ddp.get_submodule(region_name)
+                assert isinstance(region, torch.nn.ModuleList), f'compile_regions: "{region_name}" should be a nn.ModuleList, but got {type(region)}.'
+                for block in region:
+                    block.compile(mode=compile_mode, fullgraph=True, dynamic=False)
+        elif getattr(cfg.trainer, 'compile', False):
+            model_without_ddp.compile(mode=compile_mode, fullgraph=False, dynamic=False)
+        return model_without_ddp
+    
     @staticmethod
     def ddp_wrapper(cfg, model_without_ddp):
         if cfg.env.distributed:
-            model_without_ddp = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model_without_ddp)
+            if getattr(cfg.env, 'sync_bn', True):
+                model_without_ddp = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model_without_ddp)
             
-            return torch.nn.parallel.DistributedDataParallel(model_without_ddp, device_ids=[cfg.env.local_rank],
+            model = torch.nn.parallel.DistributedDataParallel(model_without_ddp, device_ids=[cfg.env.local_rank],
                 find_unused_parameters=cfg.env.find_unused_parameters,
+                static_graph=getattr(cfg.env, 'ddp_static_graph', False),
+                gradient_as_bucket_view=getattr(cfg.env, 'ddp_gradient_as_bucket_view', True),
             )
+            
+            ddp_comm_hook = getattr(cfg.env, 'ddp_comm_hook', None)
+            if ddp_comm_hook is not None:
+                from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+                assert ddp_comm_hook in ['fp16', 'bf16'], f'Unknown env.ddp_comm_hook: {ddp_comm_hook}'
+                if dist.get_backend() == 'nccl':
+                    model.register_comm_hook(state=None, hook=getattr(default_hooks, f'{ddp_comm_hook}_compress_hook'))
+                else:
+                    warnings.warn(f'env.ddp_comm_hook "{ddp_comm_hook}" is only used with the nccl backend, ignored with "{dist.get_backend()}".')
+            return model
         else:
             return model_without_ddp
     
+    @staticmethod
+    def load_checkpoint(checkpoint_path, map_location='cpu'):
+        '''
+        torch.load with "weights_only=True" (restricted unpickler) and, when loading to cpu, "mmap=True" (storages are memory-mapped instead of read into memory).
+        mmap needs torch>=2.1 and is not used for non-cpu map_location.
+        Falls back to the full unpickler (with a warning) if the checkpoint holds objects other than tensors and primitive containers.
+        '''
+        load_kwargs = {'map_location': map_location}
+        load_params = inspect.signature(torch.load).parameters
+        if 'mmap' in load_params and str(map_location) == 'cpu':
+            load_kwargs['mmap'] = True
+        if 'weights_only' in load_params:
+            try:
+                return torch.load(checkpoint_path, weights_only=True, **load_kwargs)
+            except pickle.UnpicklingError as e:
+                warnings.warn(f'Loading {checkpoint_path} with "weights_only=True" failed ({e}), falling back to "weights_only=False".')
+                load_kwargs['weights_only'] = False
+        return torch.load(checkpoint_path, **load_kwargs)
+    
     @staticmethod
     def load_state_dict_with_more_info(module, state_dict, strict=False, print_keys_level=1):
         missing_keys, unexpected_keys = module.load_state_dict(state_dict, strict=strict)
@@ -1029,16 +1165,47 @@ class ModelMisc:
 
 class LoggerMisc:
     class MultiTQDM:
+        _resizable_instances = weakref.WeakSet()
+        _sigwinch_registered = False
+        _prev_sigwinch_handler = None
+        
         def __init__(self, postlines=1, *args, **kwargs) -> None:
+            # "dynamic_ncols" makes tqdm ask for the terminal size at every refresh,
+            # so use a fixed ncols instead and only update it on terminal resizing (SIGWINCH)
+            # NOTE: "maxinterval=inf" is kept, which stops the tqdm monitor thread from forcing refreshes (e.g. when paused for validation)
+            resizable = kwargs.pop('dynamic_ncols', False)
+            if resizable:
+                kwargs.setdefault('ncols', shutil.get_terminal_size().columns)
             self.bar_main = tqdm(*args, **kwargs)
             self.postlines = postlines
             self.bar_postlines = [tqdm(
                 total=0,
-                dynamic_ncols=True,
+                ncols=self.bar_main.ncols,
                 position=i + 1,
                 maxinterval=inf,
                 bar_format='{desc}' 
             ) for i in range(postlines)]
+            if resizable:
+                LoggerMisc.MultiTQDM._register_resizable(self)
+        
+        @staticmethod
+        def _register_resizable(multi_tqdm):
+            LoggerMisc.MultiTQDM._resizable_instances.add(multi_tqdm)
+            if not LoggerMisc.MultiTQDM._sigwinch_registered and hasattr(signal, 'SIGWINCH'):
+                try:
+                    LoggerMisc.MultiTQDM._prev_sigwinch_handler = signal.signal(signal.SIGWINCH, LoggerMisc.MultiTQDM._on_resize)
+                    LoggerMisc.MultiTQDM._sigwinch_registered = True
+                except ValueError:  # not in the main thread
+                    pass
+        
+        @staticmethod
+        def _on_resize(signum, frame):
+            ncols = shutil.get_terminal_size().columns
+            for multi_tqdm in list(LoggerMisc.MultiTQDM._resizable_instances):
+                for bar in [multi_tqdm.bar_main] + multi_tqdm.bar_postlines:
+                    bar.ncols = ncols
+            if callable(LoggerMisc.MultiTQDM._prev_sigwinch_handler):
+                LoggerMisc.MultiTQDM._prev_sigwinch_handler(signum, frame)
         
         def unpause(self):
             self.bar_main.unpause()
@@ -1050,6 +1217,7 @@ class LoggerMisc:
             self.bar_main.reset()
         
         def close(self):
+            LoggerMisc.MultiTQDM._resizable_instances.discard(self)
             self.bar_main.close()
             for bar_postline in self.bar_postlines:
                 bar_postline.close()
@@ -1110,13 +1278,12 @@ class LoggerMisc:
     def logging(loggers, group, output_dict, step):
         if DistMisc.is_main_process():
             if hasattr(loggers, 'wandb_run'):
-                for k, v in output_dict.items():
-                    if k == 'epoch':
-                        loggers.wandb_run.log({k: v}, step=step)  # log epoch without group
-                    else:
-                        loggers.wandb_run.log({f'{group}/{k}': v}, step=step)
-                    # loggers.wandb_run.log({'output_image': [wandb.Image(output_dict['output_image'])]}, step=step)
-                    # loggers.wandb_run.log({'output_video': wandb.Video(output_dict['output_video'], fps=30, format='mp4')}, step=step)
+                loggers.wandb_run.log(
+                    {(k if k == 'epoch' else f'{group}/{k}'): v for k, v in output_dict.items()},  # log epoch without group
+                    step=step,
+                    )  # one call (one lock and one serialization) per step instead of one per key
+                # loggers.wandb_run.log({'output_image': [wandb.Image(output_dict['output_image'])]}, step=step)
+                # loggers.wandb_run.log({'output_video': wandb.Video(output_dict['output_video'], fps=30, format='mp4')}, step=step)
             if hasattr(loggers, 'tensorboard_run'):
                 for k, v in output_dict.items():
                     if k == 'epoch':
@@ -1156,7 +1323,9 @@ class LoggerMisc:
     
     @staticmethod
     def output_dir_time_and_extras(cfg, is_infer=False):
-        extras = '_'.join([cfg.info.infer_start_time if is_infer else cfg.info.start_time] + ConfigMisc.get_specific_list(cfg, cfg.info.name_tags))
+        # inference dirs are named before "special_config_adjustment" (which resolves "info.name_tag_values"), so resolve the name_tags here
+        name_tag_values = ConfigMisc.get_specific_list(cfg, cfg.info.name_tags) if is_infer else cfg.info.name_tag_values
+        extras = '_'.join([cfg.info.infer_start_time if is_infer else cfg.info.start_time] + name_tag_values)
         if cfg.special.debug is not None:
             extras = 'debug_' + extras
         return extras
@@ -1271,14 +1440,43 @@ class TensorMisc:
         else:
             raise TypeError(f'Tensormisc.to not implemented for Type: {type(data)} of Element: {data}')
     
+    @staticmethod
+    def pin_memory(data):
+        """
+        Same walk as `TensorMisc.to`, but pins the tensors in page-locked memory so that later `.to(device, non_blocking=True)` is a real async copy.
+        NOTE: `DataLoader(pin_memory=True)` walks dicts and lists (including `TensorMisc.BatchList`) by itself,
+            this is for batches built outside of the DataLoader's pin_memory thread.
+        """
+        if data is None:
+            return None
+        elif isinstance(data, dict):
+            return {k: TensorMisc.pin_memory(v) for k, v in data.items()}
+        elif isinstance(data, (torch.Tensor, TensorMisc.BatchList)):
+            return data.pin_memory()
+        elif isinstance(data, (str, int, float)):
+            return data
+        elif isinstance(data, list):
+            return [TensorMisc.pin_memory(d) for d in data]
+        elif isinstance(data, tuple):
+            raise TypeError(f'Please use `list` instead of `tuple` in data as `pin_memory=True` will convert all tuples to lists')
+        else:
+            raise TypeError(f'Tensormisc.pin_memory not implemented for Type: {type(data)} of Element: {data}')
+    
     class BatchList(UserList):
         def to(self, *arg, **kwargs):
             return TensorMisc.BatchList([TensorMisc.to(x, *arg, **kwargs) for x in self])
+        
+        def pin_memory(self):
+            return TensorMisc.BatchList([TensorMisc.pin_memory(x) for x in self])
     
     class NotToCudaBatchList(BatchList):
         def to(self, *arg, **kwargs):
             return self
         
+        def pin_memory(self):
+            # never goes to cuda, so nothing to pin
+            return self
+        
     class GradCollector:
         def __init__(self, x):
             x: torch.Tensor
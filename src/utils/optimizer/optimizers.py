@@ -1,3 +1,4 @@
+import inspect
 from typing import List
 
 import torch
@@ -154,13 +155,25 @@ class OptimizerUtils:
         return modules_for_grad_norm
     
     
+    @staticmethod
+    def _get_step_impl_kwargs(cfg, optimizer_cfg, optimizer_class):
+        # on cuda (all params are already on the device), a fused step is one kernel for all params, foreach is the multi-tensor fallback
+        if cfg.env.device != 'cuda':
+            return {}
+        if getattr(optimizer_cfg, 'fused', True) and 'fused' in inspect.signature(optimizer_class.__init__).parameters:
+            return {'fused': True}
+        return {'foreach': True}
+    
+    
     @staticmethod
     def _get_integrated_optimizer(cfg, optimizer_cfg, optimizer_identifier, root_module, train_loader) -> IntegratedOptimizer:
         param_dicts_with_lr_wd = OptimizerUtils._get_param_dicts_with_specific_lr_wd(optimizer_cfg, root_module)
         if optimizer_cfg.optimizer_choice == 'adamw':
-            optimizer = torch.optim.AdamW(param_dicts_with_lr_wd, eps=getattr(optimizer_cfg, 'adamw_eps', 1.0e-8))
+            optimizer = torch.optim.AdamW(param_dicts_with_lr_wd, eps=getattr(optimizer_cfg, 'adamw_eps', 1.0e-8),
+                **OptimizerUtils._get_step_impl_kwargs(cfg, optimizer_cfg, torch.optim.AdamW))
         elif optimizer_cfg.optimizer_choice == 'sgd':
-            optimizer = torch.optim.SGD(param_dicts_with_lr_wd, momentum=getattr(optimizer_cfg, 'sgd_momentum', 0))
+            optimizer = torch.optim.SGD(param_dicts_with_lr_wd, momentum=getattr(optimizer_cfg, 'sgd_momentum', 0),
+                **OptimizerUtils._get_step_impl_kwargs(cfg, optimizer_cfg, torch.optim.SGD))
         else:
             raise ValueError(f'Unknown optimizer choice: {optimizer_cfg.optimizer_choice}')
         
@@ -175,9 +175,8 @@ class MetricLogger(object):
         summary_stack = torch.stack(summary_list, dim=0)
         dist.barrier()
         dist.all_reduce(summary_stack)
-        gathered_queue_stack = [None for _ in range(DistMisc.get_world_size())]
-        dist.all_gather_object(gathered_queue_stack, queue_stack)
-        queue_stack = torch.cat(gathered_queue_stack, dim=1)
+        # gather the queues as a tensor (queue lengths may differ among ranks) instead of pickling them with all_gather_object
+        queue_stack = DistMisc.all_gather(queue_stack.to(summary_stack.device).T.contiguous(), concat_out=True).T.cpu()
         require_sync_metric_idx = 0
         for metric in self.metrics.values():
             if metric.require_sync:
@@ -18,6 +18,9 @@ def train_portal(cfg):
     # seed everything
     PortalMisc.seed_everything(cfg)
     
+    # cuda backend flags (cudnn benchmark, TF32)
+    PortalMisc.set_backend_flags(cfg)
+    
     # save configs to work_dir as .yaml file (and save current project files, print config to CLI if needed)
     PortalMisc.save_configs(cfg)
     